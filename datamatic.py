@@ -4,12 +4,19 @@ A tool for generating code based on a schema of components.
 import argparse
 import pathlib
 from datamatic import main
+from datamatic.options import Options
 
 inplace_help = """\
 Scans the given directory, importing all dmx files it finds and producing source files
 that sit alongside the template files.
 """
 
+batch_help = """\
+Runs several inplace and package jobs listed in a JSON batch file in a single process, so that
+directory scans, templates, plugins and specs are only loaded once. --spec is not used; each
+job names its own spec.
+"""
+
 package_help = """\
 Given a source dir and a destination dir, import all dmx files found in the source dir, and make
 a copy of the entire source dir saved as the destination. Template files are replaced by the
@@ -29,9 +36,75 @@ def parse_args():
 
     parser.add_argument(
         "-s", "--spec",
-        required=True,
         type=pathlib.Path,
-        help="A path to the component spec JSON file"
+        help="A path to the component spec; a JSON file, a JSON Lines file or a directory of either"
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=Options.workers,
+        help="The number of processes used to render large blocks; the default of 1 renders everything serially"
+    )
+
+    parser.add_argument(
+        "--parallel-threshold",
+        type=int,
+        default=Options.parallel_threshold,
+        help="Blocks covering at least this many components are rendered in parallel"
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Where to keep information between runs, defaults to .datamatic in the scanned directory"
+    )
+
+    parser.add_argument(
+        "--shared-cache",
+        type=pathlib.Path,
+        default=None,
+        help="A directory shared by concurrent datamatic runs, so that each output is only rendered once"
+    )
+
+    parser.add_argument(
+        "--only-template",
+        default=None,
+        metavar="GLOB",
+        help="Only render templates whose path relative to --dir matches this glob (inplace only)"
+    )
+
+    parser.add_argument(
+        "--only-component",
+        action="append",
+        default=None,
+        dest="only_components",
+        metavar="NAME",
+        help="Only render this component again, reusing the output of the other unchanged components "
+             "from the last run; can be given more than once"
+    )
+
+    parser.add_argument(
+        "--post-process",
+        action="append",
+        default=[],
+        metavar="EXT=COMMAND",
+        help="Pass generated files with this extension through a command before writing them, for "
+             "example .cpp=clang-format; can be given more than once"
+    )
+
+    parser.add_argument(
+        "-q", "--quiet",
+        action="store_true",
+        help="Don't print a line for every generated file"
+    )
+
+    parser.add_argument(
+        "--report",
+        type=pathlib.Path,
+        default=None,
+        help="Save a JSON report of phase timings, per-file statistics and cache hit ratios here"
     )
 
     subparsers = parser.add_subparsers(dest="command")
@@ -56,18 +129,50 @@ def parse_args():
         "--dst",
         required=True,
         type=pathlib.Path,
-        help="A path to the dest directory that will contain all rendered files"
+        help="A path to the dest directory that will contain all rendered files, or a .tar, .tar.gz, .tgz or .zip archive"
     )
 
-    return parser.parse_args()
+    batch = subparsers.add_parser("batch", help=batch_help)
+    batch.add_argument(
+        "--jobs",
+        required=True,
+        type=pathlib.Path,
+        help="A path to the batch file listing the jobs to run"
+    )
+
+    args = parser.parse_args()
+    if args.command in {"inplace", "package"} and args.spec is None:
+        parser.error(f"--spec is required for {args.command}")
+
+    post_process = {}
+    for value in args.post_process:
+        extension, _, command = value.partition("=")
+        if not extension.startswith(".") or not command:
+            parser.error(f"--post-process must look like .ext=command, got {value!r}")
+        post_process[extension] = command
+    args.post_process = post_process
+    return args
 
 
 if __name__ == "__main__":
     args = parse_args()
     spec = args.spec
+    options = Options(
+        workers=args.workers,
+        parallel_threshold=args.parallel_threshold,
+        cache_dir=args.cache_dir,
+        shared_cache=args.shared_cache,
+        only_template=args.only_template,
+        only_components=args.only_components,
+        post_process=args.post_process,
+        quiet=args.quiet,
+        report=args.report
+    )
     if args.command == "inplace":
-        main.main_inplace(spec, args.dir)
+        main.main_inplace(spec, args.dir, options)
     elif args.command == "package":
-        main.main_package(spec, args.src, args.dst)
+        main.main_package(spec, args.src, args.dst, options)
+    elif args.command == "batch":
+        main.main_batch(args.jobs, options)
     else:
         print("No command specified")
@@ -0,0 +1,103 @@
+"""
+Writes packaged output straight into a tar or zip archive instead of a directory. Archives
+are reproducible: entries are written in sorted order with fixed timestamps, owners and
+permissions, so identical inputs give byte-identical archives.
+"""
+import gzip
+import io
+import os
+import pathlib
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+
+SUFFIXES = (".tar", ".tar.gz", ".tgz", ".zip")
+
+# Zip files cannot store times before 1980.
+_ZIP_EPOCH = 315532800
+
+
+def is_archive(path: pathlib.Path) -> bool:
+    return path.name.endswith(SUFFIXES)
+
+
+def timestamp() -> int:
+    """
+    The time given to every entry; SOURCE_DATE_EPOCH if it is set, otherwise a fixed time.
+    """
+    return int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+
+
+class ArchiveWriter:
+    """
+    Collects entries from any thread and writes them all when closed. Files added with
+    add_file are streamed from disk at that point rather than held in memory.
+    """
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add_bytes(self, name: str, data: bytes):
+        with self.lock:
+            self.entries[name] = data
+
+    def add_file(self, name: str, src: pathlib.Path):
+        with self.lock:
+            self.entries[name] = src
+
+    def close(self):
+        fd, tmp = tempfile.mkstemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as handle:
+                if self.path.name.endswith(".zip"):
+                    self._write_zip(handle)
+                else:
+                    self._write_tar(handle)
+            os.replace(tmp, self.path)
+        except BaseException:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def _sorted_entries(self):
+        return sorted(self.entries.items())
+
+    def _write_tar(self, handle):
+        compress = self.path.name.endswith((".tar.gz", ".tgz"))
+        fileobj = gzip.GzipFile(filename="", mode="wb", fileobj=handle, mtime=timestamp()) if compress else handle
+        try:
+            with tarfile.open(fileobj=fileobj, mode="w", format=tarfile.PAX_FORMAT) as tar:
+                for name, entry in self._sorted_entries():
+                    info = tarfile.TarInfo(name)
+                    info.mtime = timestamp()
+                    info.mode = 0o644
+                    if isinstance(entry, bytes):
+                        info.size = len(entry)
+                        tar.addfile(info, io.BytesIO(entry))
+                    else:
+                        info.size = entry.stat().st_size
+                        with entry.open("rb") as src:
+                            tar.addfile(info, src)
+        finally:
+            if compress:
+                fileobj.close()
+
+    def _write_zip(self, handle):
+        date_time = time.gmtime(max(timestamp(), _ZIP_EPOCH))[:6]
+        with zipfile.ZipFile(handle, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for name, entry in self._sorted_entries():
+                info = zipfile.ZipInfo(name, date_time=date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                info.external_attr = 0o644 << 16
+                if isinstance(entry, bytes):
+                    zf.writestr(info, entry)
+                else:
+                    with entry.open("rb") as src, zf.open(info, "w") as dst:
+                        shutil.copyfileobj(src, dst)
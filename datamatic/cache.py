@@ -0,0 +1,297 @@
+"""
+Caches that are shared between all of the templates rendered in a single run, and the
+manifest that carries information about generated files from one run to the next.
+"""
+import collections
+import hashlib
+import json
+import pathlib
+import threading
+import time
+from typing import Optional
+
+from . import fileio, dependencies
+from .index import SpecIndex
+from .views import SpecView
+
+
+class RenderCache:
+    """
+    Holds rendered output that can be reused across templates, along with hit/miss counts
+    for each kind of cached item.
+    """
+    def __init__(self):
+        self.blocks = {}
+        self.indexes = {}
+        self.views = {}
+        self.partials = {}
+        self.partial_sources = {}
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+
+    def get_block(self, key):
+        out = self.blocks.get(key)
+        if out is None:
+            self.misses["block"] += 1
+        else:
+            self.hits["block"] += 1
+        return out
+
+    def put_block(self, key, out):
+        self.blocks[key] = out
+
+    def get_partial(self, key):
+        entry = self.partials.get(key)
+        if entry is None:
+            self.misses["partial"] += 1
+            return None
+        self.hits["partial"] += 1
+        return entry[1]
+
+    def put_partial(self, key, comp, out):
+        # The component is kept alive so that its id in the key is not reused.
+        self.partials[key] = (comp, out)
+
+    def partial_lines(self, path, read):
+        """
+        Returns the lines of the partial at path, calling read the first time it is needed.
+        """
+        if path not in self.partial_sources:
+            self.partial_sources[path] = read()
+        return self.partial_sources[path]
+
+    def view(self, spec, flags):
+        """
+        Returns the SpecView for the given spec and flags, shared by every template.
+        """
+        key = (id(spec), frozenset(flags.items()))
+        if key not in self.views:
+            self.views[key] = SpecView(spec, flags)
+        return self.views[key]
+
+    def index(self, spec, flags):
+        """
+        Returns the SpecIndex over the view of the given spec and flags, shared by every
+        template.
+        """
+        key = (id(spec), frozenset(flags.items()))
+        if key not in self.indexes:
+            self.indexes[key] = SpecIndex(self.view(spec, flags), flags)
+        return self.indexes[key]
+
+    def summary(self):
+        """
+        Returns a line per cache kind describing how often it was hit.
+        """
+        lines = []
+        for kind in sorted(self.hits.keys() | self.misses.keys()):
+            hits, misses = self.hits[kind], self.misses[kind]
+            lines.append(f"{kind.capitalize()} cache: {hits} hits, {misses} misses")
+        return "\n".join(lines)
+
+
+class Manifest:
+    """
+    Records the size, mtime and content hash of every generated file. If a file still has
+    the recorded size and mtime on the next run, its hash is known without reading it.
+    For post-processed files, the key of the output before post-processing is recorded
+    too, so the post-processor is not run again for the same output. Also records the
+    dependencies of each template, see dependencies.py.
+    """
+    def __init__(self, path: Optional[pathlib.Path] = None):
+        self.path = path
+        self.outputs = {}
+        self.templates = {}
+        self.lock = threading.Lock()
+
+        if path is not None and path.exists():
+            try:
+                with path.open() as handle:
+                    data = json.load(handle)
+                self.outputs = data.get("outputs", {})
+                self.templates = data.get("templates", {})
+            except (ValueError, AttributeError):
+                pass  # A corrupt manifest only costs a slower run
+
+    def get_output(self, dst: pathlib.Path):
+        return self.outputs.get(str(dst))
+
+    def trusted_output(self, dst: pathlib.Path, stat):
+        """
+        Returns the record for dst if it can be trusted to describe a file with the given
+        stat, otherwise None. Records taken too soon after the file was modified are not
+        trusted, see fileio.RACY_NS; they are replaced once the file has been read again.
+        """
+        record = self.get_output(dst)
+        if (
+            record is None
+            or (record["size"], record["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns)
+            or record.get("recorded_ns", 0) - stat.st_mtime_ns <= fileio.RACY_NS
+        ):
+            return None
+        return record
+
+    def output_is_current(self, dst: pathlib.Path):
+        """
+        Returns True if dst has not changed since it was last recorded.
+        """
+        try:
+            stat = dst.stat()
+        except FileNotFoundError:
+            return False
+        return self.trusted_output(dst, stat) is not None
+
+    def get_template(self, src: pathlib.Path):
+        return self.templates.get(str(src))
+
+    def set_template(self, src: pathlib.Path, record):
+        with self.lock:
+            if record is None:
+                self.templates.pop(str(src), None)
+            else:
+                self.templates[str(src)] = record
+
+    def raw_is_current(self, dst: pathlib.Path, raw: str):
+        """
+        Returns True if dst was written from the post-processed output with the given key,
+        and has not changed since.
+        """
+        record = self.get_output(dst)
+        if record is None or record.get("raw") != raw:
+            return False
+        try:
+            stat = dst.stat()
+        except FileNotFoundError:
+            return False
+        if self.trusted_output(dst, stat) is not None:
+            return True
+        return stat.st_size == record["size"] and fileio.file_digest(dst) == record["sha256"]
+
+    def set_output(self, dst: pathlib.Path, stat, digest: str, raw: Optional[str] = None):
+        """
+        Records dst; raw is the post-processor's key for the output dst was written from,
+        if it was post-processed.
+        """
+        record = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "recorded_ns": time.time_ns(),
+            "sha256": digest
+        }
+        if raw is not None:
+            record["raw"] = raw
+        with self.lock:
+            self.outputs[str(dst)] = record
+
+    def save(self):
+        if self.path is None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            data = json.dumps({"outputs": self.outputs, "templates": self.templates}, indent=1, sort_keys=True)
+        fileio.atomic_write(self.path, data.encode())
+
+
+class ResultStore:
+    """
+    Rendered outputs shared between datamatic processes through a directory. Each output is
+    keyed by a hash of everything it was rendered from: the template, its partials, the spec
+    and the plugin code. A process that wants an output holds the lock for its key while
+    looking it up and rendering it, so other processes wait and then reuse the stored output
+    rather than rendering it again.
+    """
+    def __init__(self, directory: pathlib.Path, base: str):
+        self.directory = directory
+        self.base = base  # The hash of the spec and plugin code
+
+    def key(self, src: pathlib.Path, lines, partials):
+        """
+        partials is a list of (path, hash) pairs for the partials the template includes.
+        """
+        return dependencies.digest([self.base, str(src.resolve()), lines, partials])
+
+    def lock(self, key: str):
+        return fileio.FileLock(self.directory / "locks" / f"{key}.lock")
+
+    def path(self, key: str):
+        return self.directory / "results" / key[:2] / f"{key}.out"
+
+    def get(self, key: str):
+        try:
+            return self.path(key).read_bytes().decode("utf-8")
+        except FileNotFoundError:
+            return None
+
+    def put(self, key: str, out: str):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fileio.atomic_write(path, out.encode("utf-8"))
+
+
+class ChunkStore:
+    """
+    The output of each component in each block of a template, kept between runs so that
+    --only-component runs can reuse the output of the other components. Each record is only
+    used if the template, its partials, the plugin code, the global fields and the list of
+    components and flags are unchanged, and each component's output is only reused if that
+    component is unchanged.
+    """
+    def __init__(self, directory: pathlib.Path, base: str, components: dict):
+        self.directory = directory
+        self.base = base  # The hash of the plugin code and everything but the components
+        self.components = components  # The hash of each uniquely named component
+
+    def key(self, lines, partials):
+        return dependencies.digest([self.base, lines, partials])
+
+    def path(self, src: pathlib.Path):
+        name = hashlib.sha256(str(src.resolve()).encode()).hexdigest()
+        return self.directory / "chunks" / f"{name}.json"
+
+    def reuse(self, src: pathlib.Path, key: str, only):
+        """
+        Returns the reusable outputs of the previous run of src, a dict of name to output
+        for each block, or None if there is no usable record. Components named in only are
+        never reused.
+        """
+        try:
+            with self.path(src).open() as handle:
+                record = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(record, dict) or record.get("key") != key:
+            return None
+
+        previous = record["components"]
+        return [
+            {
+                name: out for name, out in block
+                if isinstance(name, str) and name not in only
+                and name in self.components and previous.get(name) == self.components[name]
+            }
+            for block in record["blocks"]
+        ]
+
+    def save(self, src: pathlib.Path, key: str, chunks):
+        path = self.path(src)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        data = json.dumps({"key": key, "components": self.components, "blocks": chunks})
+        fileio.atomic_write(path, data.encode())
+
+
+def load_validated(path: pathlib.Path) -> dict:
+    """
+    Reads the record of validated spec files saved by save_validated, returning an empty dict if
+    there isn't one.
+    """
+    try:
+        with path.open() as handle:
+            validated = json.load(handle)
+    except (OSError, ValueError):
+        return {}
+    return validated if isinstance(validated, dict) else {}
+
+
+def save_validated(path: pathlib.Path, validated: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fileio.atomic_write(path, json.dumps(validated, indent=1, sort_keys=True).encode())
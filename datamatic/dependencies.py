@@ -0,0 +1,161 @@
+"""
+Works out which parts of the spec a template depends on, so that templates can be skipped
+when the spec changes in ways they cannot see.
+
+Dependencies are named by strings:
+    "structure"       which components and attributes exist, and their flags
+    "Comp::field"     a field on every component ("Comp::*" for all component fields)
+    "Attr::field"     a field on every attribute ("Attr::*" for all attribute fields)
+    "Global::field"   a top level field of the spec
+    "code:path"       the python file defining a function used by the template
+    "file:path"       a partial included by the template
+"""
+import hashlib
+import json
+import pathlib
+
+from . import generator
+
+
+# The template depends on something that cannot be tracked, so must always be rendered.
+UNTRACKED = None
+
+# The namespaces tokens are looked up in.
+NAMESPACES = ("Comp", "Attr", "Global")
+
+# Every template depends on all of datamatic's own code.
+PACKAGE_SOURCES = sorted(pathlib.Path(__file__).parent.glob("*.py"))
+
+
+def code_dependency(function):
+    code = getattr(function, "__code__", None)
+    if code is None:
+        return UNTRACKED
+    return f"code:{code.co_filename}"
+
+
+def template_dependencies(file, lines, method_register, includes=()):
+    """
+    Scans the tokens in the given template lines, and any partials they include, and returns
+    the set of dependencies, or UNTRACKED if a function is used that has not declared what
+    it reads.
+    """
+    deps = {"structure", *(f"code:{path}" for path in PACKAGE_SOURCES)}
+    for line in lines:
+        if line.lstrip().startswith(generator.INCLUDE):
+            path = generator.include_path(file, line)
+            if path in includes:
+                return UNTRACKED  # Rendering will report this
+            try:
+                partial_lines = generator.read_partial(file, path)
+            except generator.GeneratorError:
+                return UNTRACKED
+            partial_deps = template_dependencies(path, partial_lines, method_register, includes + (path,))
+            if partial_deps is UNTRACKED:
+                return UNTRACKED
+            deps |= partial_deps
+            deps.add(f"file:{path}")
+            continue
+
+        for match in generator.TOKEN.finditer(line):
+            raw = match.group(1)
+            if not any(f"{namespace}::" in raw for namespace in NAMESPACES):
+                continue  # Braces in the output language, such as {{0}} in C++
+            try:
+                token = generator.parse_token(file, raw)
+            except generator.GeneratorError:
+                return UNTRACKED  # Rendering will report this
+            if token.namespace not in NAMESPACES:
+                return UNTRACKED
+            function = method_register.find(token.namespace, token.function_name)
+            if function is None:
+                deps.add(f"{token.namespace}::{token.function_name}")
+                continue
+
+            reads = getattr(function, "reads", None)
+            code = code_dependency(function)
+            if reads is None or code is UNTRACKED:
+                return UNTRACKED
+            deps.add(code)
+            deps.update(reads)
+    return deps
+
+
+def partial_files(file, lines, includes=()):
+    """
+    Returns the paths of every partial the template includes, directly or through other
+    partials, in the order they are first included.
+    """
+    paths = []
+    for line in lines:
+        if not line.lstrip().startswith(generator.INCLUDE):
+            continue
+        path = generator.include_path(file, line)
+        if path in includes or path in paths:
+            continue
+        paths.append(path)
+        try:
+            partial_lines = generator.read_partial(file, path)
+        except generator.GeneratorError:
+            continue  # Rendering will report this
+        for nested in partial_files(path, partial_lines, includes + (path,)):
+            if nested not in paths:
+                paths.append(nested)
+    return paths
+
+
+def digest(value):
+    data = json.dumps(value, sort_keys=True, default=repr)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class Fingerprints:
+    """
+    Computes a hash for each dependency against the current spec. Each one is computed at
+    most once per run.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.values = {}
+
+    def get(self, dep):
+        if dep not in self.values:
+            self.values[dep] = self.compute(dep)
+        return self.values[dep]
+
+    def compute(self, dep):
+        spec = self.spec
+        components = spec["components"]
+
+        if dep == "structure":
+            return digest([
+                spec.get("flag_defaults"),
+                [[comp.get("flags"), [attr.get("flags") for attr in comp["attributes"]]] for comp in components]
+            ])
+
+        if dep.startswith(("code:", "file:")):
+            path = pathlib.Path(dep[len("code:"):])
+            try:
+                return hashlib.sha256(path.read_bytes()).hexdigest()
+            except OSError:
+                return None
+
+        namespace, field = dep.split("::", 1)
+        if namespace == "Global":
+            return digest(spec.get(field))
+        if namespace == "Comp":
+            if field == "*":
+                return digest([{k: v for k, v in comp.items() if k != "attributes"} for comp in components])
+            return digest([comp.get(field) for comp in components])
+        if field == "*":
+            return digest([comp["attributes"] for comp in components])
+        return digest([[attr.get(field) for attr in comp["attributes"]] for comp in components])
+
+    def all(self, deps):
+        return {dep: self.get(dep) for dep in sorted(deps)}
+
+    def unchanged(self, recorded):
+        """
+        Returns True if every recorded dependency still has the recorded fingerprint.
+        """
+        return all(self.get(dep) == value for dep, value in recorded.items())
@@ -0,0 +1,183 @@
+"""
+Runs file reads, comparisons, writes and copies on a pool of threads so that slow
+filesystems do not serialise the whole run. Rendering stays on the calling thread.
+"""
+import collections
+import hashlib
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+class FilePool:
+    """
+    A thread pool with a bound on the number of queued tasks. Submitting blocks once
+    max_pending tasks are in flight, which stops reads racing too far ahead of rendering.
+    """
+    def __init__(self, workers: int = 8, max_pending: int = 64):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.max_pending = max_pending
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.executor.shutdown(wait=True)
+
+    def submit(self, function, *args):
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+
+    def read_ahead(self, paths, read):
+        """
+        Yields (path, read(path)) for each path in order, with reads for the following
+        paths already running in the background.
+        """
+        window = max(1, self.max_pending // 2)
+        pending = collections.deque()
+        for path in paths:
+            pending.append((path, self.submit(read, path)))
+            if len(pending) >= window:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+
+# Files modified this close to when they were last looked at may be modified again without
+# the mtime changing, depending on the timestamp resolution of the filesystem, so their
+# size and mtime can't be trusted to show that they have not changed.
+RACY_NS = 2_000_000_000
+
+
+# The permissions new files get when created normally; mkstemp always uses 0600.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def file_digest(path, chunk_size: int = 1 << 16):
+    """
+    Returns the sha256 of the file at the given path without reading it all into memory.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        while chunk := handle.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def atomic_write(path, data: bytes, mode=None):
+    """
+    Writes data to a temporary file next to path and then moves it into place, so that
+    readers see either the old contents or the new contents, never a partial file.
+    """
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix=f".{os.path.basename(path)}.",
+        suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            handle.write(data)
+        os.chmod(tmp, mode if mode is not None else 0o666 & ~_UMASK)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def copy_file(src, dst):
+    try:
+        shutil.copy(src, dst)
+    except PermissionError:
+        pass
+
+
+def lock_path(path):
+    """
+    The lock file for writing path, hidden next to it.
+    """
+    path = pathlib.Path(path)
+    return path.parent / f".{path.name}.lock"
+
+
+class FileLock:
+    """
+    An exclusive lock shared between processes, held on a lock file that is deleted when the
+    lock is released. The operating system releases the lock if the holding process dies, so
+    a lock file left behind by a crash is simply locked again by the next process.
+    """
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.handle = None
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        while True:
+            handle = open(self.path, "a+b")
+            try:
+                _lock(handle)
+                # The holder deletes the file before unlocking it, so the file locked here may
+                # no longer be the one at the path, in which case it must be opened again.
+                try:
+                    current = os.path.samestat(os.fstat(handle.fileno()), os.stat(self.path))
+                except FileNotFoundError:
+                    current = False
+            except BaseException:
+                handle.close()
+                raise
+            if current:
+                self.handle = handle
+                return self
+            handle.close()
+
+    def __exit__(self, *exc):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass  # Windows cannot delete open files, the next process reuses it
+        _unlock(self.handle)
+        self.handle.close()
+        self.handle = None
+
+
+def _lock(handle):
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            time.sleep(0.05)
+
+
+def _unlock(handle):
+    if fcntl is not None:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+    else:
+        handle.seek(0)
+        msvcrt.locking(handle.fileno(), msvcrt.LK_UNLCK, 1)
@@ -1,10 +1,19 @@
 import re
+import os
+import pathlib
+import hashlib
+import locale
 from typing import Tuple, Literal, Optional
 from dataclasses import dataclass
-from functools import partial
+from functools import partial, lru_cache
+import contextlib
+import multiprocessing
 import parse
 import ast
-from . import utilities
+from . import utilities, fileio
+from .options import Options
+from .index import SpecIndex
+from .views import SpecView
 
 
 TOKEN = re.compile(r"\{\{(.*?)\}\}")
@@ -18,6 +27,10 @@ class GeneratorError(Exception):
     def __str__(self):
         return f"[{self.file}] {super().__str__()}"
 
+    def __reduce__(self):
+        # Needed to send errors back from worker processes.
+        return (type(self), (self.file, *self.args))
+
 
 @dataclass
 class Context:
@@ -25,11 +38,26 @@ class Context:
     comp: dict
     attr: Optional[dict]  # Only populated for attrmethods
     flags: dict
+    index: Optional[SpecIndex] = None  # Shared lookups over the spec for these flags
+
+    def __post_init__(self):
+        if self.index is None:
+            self.index = SpecIndex(self.spec, self.flags)
 
     @property
     def namespace(self):
         return "Attr" if self.attr is not None else "Comp"
 
+    @property
+    def position(self):
+        """
+        The index of the current component, or attribute for attrmethods, among those that
+        match the flags.
+        """
+        if self.attr is not None:
+            return self.index.attr_position(self.comp, self.attr)
+        return self.index.position(self.comp)
+
 
 @dataclass(frozen=True)
 class Token:
@@ -70,7 +98,22 @@ def parse_token_string(file, raw_string: str) -> Token:
         function_name=function_name,
         args=args,
     )
-    
+
+
+@lru_cache(maxsize=None)
+def _parse_token_cached(raw_string: str) -> Token:
+    return parse_token_string(None, raw_string)
+
+
+def parse_token(file, raw_string: str) -> Token:
+    """
+    A cached parse_token_string; the same tokens appear many times across templates and runs.
+    """
+    try:
+        return _parse_token_cached(raw_string)
+    except GeneratorError as e:
+        raise GeneratorError(file, *e.args) from None
+
 
 def apply_flags_to_spec(spec, flags):
     """
@@ -101,65 +144,282 @@ def apply_flags_to_spec(spec, flags):
     return components
 
 
-def replace_token(matchobj, file, comp, attr, spec, flags, method_register):
+def replace_token(matchobj, file, comp, attr, spec, flags, method_register, index=None):
     """
     Parse the replacement token in the matchobj to figure out the namespace, function name
     and any args provided. Get the function and then pass the comp/attr and any extra arguments.
     """
-    token = parse_token_string(file, matchobj.group(1))
+    token = parse_token(file, matchobj.group(1))
     function = method_register.get(token.namespace, token.function_name)
-    ctx = Context(spec=spec, comp=comp, attr=attr, flags=flags)
+    ctx = Context(spec=spec, comp=comp, attr=attr, flags=flags, index=index)
     return function(ctx, *token.args)
 
 
-def process_block(file, block, flags, spec, method_register):
+def attr_column(file, token, flags, spec, method_register, comp, attrs, index):
+    """
+    Returns the value of the token for each of the given attributes. Batch functions are
+    called once for the whole list, and plain field lookups are read from a column cached
+    on the index.
+    """
+    if token.namespace == "Attr":
+        batch = method_register.get_batch(token.function_name)
+        if batch is not None:
+            ctx = Context(spec=spec, comp=comp, attr=None, flags=flags, index=index)
+            column = list(batch(ctx, attrs, *token.args))
+            if len(column) != len(attrs):
+                raise GeneratorError(
+                    file, f"Attr::{token.function_name} returned {len(column)} values for {len(attrs)} attributes"
+                )
+            return column
+
+        if not token.args and method_register.find("Attr", token.function_name) is None:
+            if index is not None:
+                return index.column(comp, token.function_name)
+            return [attr[token.function_name] for attr in attrs]
+
+    function = method_register.get(token.namespace, token.function_name)
+    return [
+        function(Context(spec=spec, comp=comp, attr=attr, flags=flags, index=index), *token.args)
+        for attr in attrs
+    ]
+
+
+def expand_attr_line(file, line, flags, spec, method_register, comp, index=None):
+    """
+    Renders a line containing Attr tokens once for each attribute of the component. Each
+    token is evaluated for all attributes at once, and the rows are then built by
+    formatting the line with one value from each column.
+    """
+    attrs = index.attributes(comp) if index is not None else utilities.filter_flags(comp["attributes"], flags)
+    if not attrs:
+        return ""
+
+    parts = TOKEN.split(line)
+    if any("{{Attr::" in part for part in parts[0::2]):
+        raise GeneratorError(file, f"Unterminated Attr token in line: {line}")
+    literals = [part.replace("{", "{{").replace("}", "}}") for part in parts[0::2]]
+    columns = [
+        attr_column(file, parse_token(file, raw), flags, spec, method_register, comp, attrs, index)
+        for raw in parts[1::2]
+    ]
+
     out = ""
-    for comp in spec["components"]:
-        if not utilities.flag_match(comp, flags):
+    fmt = "{}".join(literals)
+    for attr, values in zip(attrs, zip(*columns)):
+        newline = fmt.format(*values)
+        while "{{Attr::" in newline:  # A function returned more tokens
+            expanded = TOKEN.sub(partial(
+                replace_token,
+                file=file,
+                comp=comp,
+                attr=attr,
+                spec=spec,
+                flags=flags,
+                method_register=method_register,
+                index=index
+            ), newline)
+            if expanded == newline:
+                raise GeneratorError(file, f"Unterminated Attr token in line: {newline}")
+            newline = expanded
+        out += newline + "\n"
+    return out
+
+
+INCLUDE = "DATAMATIC_INCLUDE"
+
+
+def include_path(file, line):
+    """
+    Returns the partial file named by an include line, relative to the including file.
+    """
+    parts = line.split()
+    if len(parts) != 2:
+        raise GeneratorError(file, f"Expected '{INCLUDE} <path>', got '{line.strip()}'")
+    return pathlib.Path(file).parent / parts[1]
+
+
+def read_partial(file, path):
+    try:
+        with path.open() as partial_file:
+            return [line.rstrip() for line in partial_file]
+    except FileNotFoundError:
+        raise GeneratorError(file, f"Included file {path} does not exist")
+
+
+def render_partial(file, path, flags, spec, method_register, comp, index=None, cache=None, includes=()):
+    """
+    Renders an included partial for the given component. With a cache, each partial is only
+    read once per run and its output for a given component and set of flags is reused by
+    every template that includes it.
+    """
+    if path in includes:
+        raise GeneratorError(file, f"{path} includes itself")
+
+    if cache is None:
+        lines = read_partial(file, path)
+        return render_component(path, lines, flags, spec, method_register, comp, index, None, includes + (path,))
+
+    key = (path, frozenset(flags.items()), id(comp))
+    out = cache.get_partial(key)
+    if out is None:
+        lines = cache.partial_lines(path, lambda: read_partial(file, path))
+        out = render_component(path, lines, flags, spec, method_register, comp, index, cache, includes + (path,))
+        cache.put_partial(key, comp, out)
+    return out
+
+
+def render_component(file, block, flags, spec, method_register, comp, index=None, cache=None, includes=()):
+    """
+    Renders the block for a single component.
+    """
+    out = ""
+    for line in block:
+        if line.lstrip().startswith(INCLUDE):
+            path = include_path(file, line)
+            out += render_partial(file, path, flags, spec, method_register, comp, index, cache, includes)
             continue
 
-        for line in block:
-            had_comp_substitute = False
-            while "{{Comp::" in line:
-                had_comp_substitute = True
-                line = TOKEN.sub(partial(
-                    replace_token,
-                    file=file,
-                    comp=comp,
-                    attr=None,
-                    spec=spec,
-                    flags=flags,
-                    method_register=method_register
-                ), line)
-
-            if "{{Attr::" in line:
-                for attr in comp["attributes"]:
-                    if not utilities.flag_match(attr, flags):
-                        continue
-
-                    newline = line
-                    had_attr_substitute = False
-                    while "{{Attr::" in newline:
-                        had_attr_substitute = True
-                        newline = TOKEN.sub(partial(
-                            replace_token,
-                            file=file,
-                            comp=comp,
-                            attr=attr,
-                            spec=spec,
-                            flags=flags,
-                            method_register=method_register
-                        ), newline)
-
-                    if not (had_attr_substitute and line == ""): # If a symbol substitution resulted in an empty line, don't add it
-                        out += newline + "\n"
-            else:
-                if not (had_comp_substitute and line == ""):  # If a symbol substitution resulted in an empty line, don't add it
-                    out += line + "\n"
+        had_comp_substitute = False
+        while "{{Comp::" in line:
+            had_comp_substitute = True
+            line = TOKEN.sub(partial(
+                replace_token,
+                file=file,
+                comp=comp,
+                attr=None,
+                spec=spec,
+                flags=flags,
+                method_register=method_register,
+                index=index
+            ), line)
+
+        if "{{Attr::" in line:
+            out += expand_attr_line(file, line, flags, spec, method_register, comp, index)
+        else:
+            if not (had_comp_substitute and line == ""):  # If a symbol substitution resulted in an empty line, don't add it
+                out += line + "\n"
 
     return out
 
 
+# The spec and method register used by a worker process; set when the worker starts.
+_worker_state = None
+
+
+def _init_worker(spec, method_register):
+    global _worker_state
+    _worker_state = (spec, method_register, {})
+
+
+def _render_chunk(file, block, flags, indices):
+    spec, method_register, views = _worker_state
+    key = frozenset(flags.items())
+    if key not in views:
+        view = SpecView(spec, flags)
+        views[key] = (view, SpecIndex(view, flags))
+    view, index = views[key]
+    components = view["components"]
+    return [render_component(file, block, flags, view, method_register, components[i], index) for i in indices]
+
+
+def can_render_in_parallel():
+    """
+    Workers are forked so that they inherit the method register; functions loaded from dmx
+    files are closures which cannot be pickled and sent to a spawned process.
+    """
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+@contextlib.contextmanager
+def worker_pool(spec, method_register, options):
+    """
+    Forks the processes that render large blocks of templates rendered with the given spec
+    and method register, yielding None if options.workers is 1 or fork is not available.
+    The processes are forked straight away, so this must be entered before the run starts
+    any threads; forking a process while other threads hold locks can deadlock the child.
+    """
+    if options.workers <= 1 or not can_render_in_parallel():
+        yield None
+        return
+
+    pool = multiprocessing.get_context("fork").Pool(options.workers, _init_worker, (spec, method_register))
+    try:
+        yield pool
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def render_parallel(file, block, flags, indices, workers, worker_count):
+    """
+    Splits the given component indices into chunks and renders them on the worker pool,
+    returning the output for each component in the original order. Each worker sees the
+    whole spec, so positional functions such as if_first and if_last behave as they do
+    serially.
+    """
+    chunk_count = min(len(indices), worker_count * 4)
+    chunk_size = -(-len(indices) // chunk_count)
+    chunks = [indices[i:i + chunk_size] for i in range(0, len(indices), chunk_size)]
+    results = workers.starmap(_render_chunk, [(file, block, flags, chunk) for chunk in chunks])
+    return [out for result in results for out in result]
+
+
+def process_block(
+    file, block, flags, spec, method_register, cache=None, options=None, chunks=None, reuse=None, workers=None
+):
+    """
+    Renders the block once for each component that matches the flags. Functions are given
+    read-only views of the spec with the flags applied, see views.py. If a cache is given,
+    identical blocks with identical flags are only rendered once per run. If a worker pool
+    from worker_pool is given, blocks covering at least options.parallel_threshold
+    components are rendered on it; it must have been started with the same spec.
+
+    If chunks is a list, a list of (name, output) pairs for the components in the block is
+    appended to it. If reuse is given, it maps component names to their output from a
+    previous run, which is used instead of rendering those components again.
+    """
+    if options is None:
+        options = Options()
+
+    if cache is not None:
+        view, index = cache.view(spec, flags), cache.index(spec, flags)
+    else:
+        view = SpecView(spec, flags)
+        index = SpecIndex(view, flags)
+    components = view["components"]
+
+    outs = None
+    if reuse is not None:
+        outs = []
+        for comp in components:
+            name = comp.get("name")
+            if isinstance(name, str) and name in reuse:
+                outs.append(reuse[name])
+            else:
+                outs.append(render_component(file, block, flags, view, method_register, comp, index, cache))
+    elif cache is not None:
+        # Includes are relative to the file, so the same lines can include different partials
+        includes = tuple(include_path(file, line) for line in block if line.lstrip().startswith(INCLUDE))
+        key = (tuple(block), frozenset(flags.items()), includes)
+        outs = cache.get_block(key)
+
+    if outs is None:
+        if workers is not None and len(components) >= options.parallel_threshold:
+            indices = list(range(len(components)))
+            outs = render_parallel(file, block, flags, indices, workers, options.workers)
+        else:
+            outs = [render_component(file, block, flags, view, method_register, comp, index, cache) for comp in components]
+        if cache is not None:
+            cache.put_block(key, tuple(outs))
+
+    if chunks is not None:
+        chunks.append([(comp.get("name"), out) for comp, out in zip(components, outs)])
+    return "".join(outs)
+
+
 def parse_flag_val(val):
     valid_vals = {"true", "false"}
     if val not in valid_vals:
@@ -178,14 +438,23 @@ def parse_flags(flags):
     return parsed_flags
 
 
-def run(src, dst, spec, method_register):
+def read_template(src):
     with src.open() as srcfile:
-        lines = srcfile.readlines()
+        return srcfile.readlines()
 
+
+def render(src, lines, spec, method_register, cache=None, options=None, chunks=None, reuse=None, workers=None):
+    """
+    Renders the lines of the template file src, returning the generated source. chunks,
+    reuse and workers are passed to process_block; reuse is a list with an entry for each
+    block.
+    """
+    global_view = cache.view(spec, {}) if cache is not None else SpecView(spec, {})
     in_block = False
     block = []
     flags = set()
     out = ""
+    block_count = 0
     for line in lines:
         line = line.rstrip()
 
@@ -196,7 +465,7 @@ def run(src, dst, spec, method_register):
                 file=src,
                 comp=None,
                 attr=None,
-                spec=spec,
+                spec=global_view,
                 flags=flags,
                 method_register=method_register
             ), line)
@@ -205,7 +474,11 @@ def run(src, dst, spec, method_register):
             if line.startswith("DATAMATIC_BEGIN"):
                 raise RuntimeError("Tried to begin a datamatic block while in another, cannot be nested")
             if line.startswith("DATAMATIC_END"):
-                out += process_block(src, block, flags, spec, method_register)
+                block_reuse = reuse[block_count] if reuse is not None and block_count < len(reuse) else None
+                out += process_block(
+                    src, block, flags, spec, method_register, cache, options, chunks, block_reuse, workers
+                )
+                block_count += 1
                 in_block = False
                 block = []
                 flags = set()
@@ -214,17 +487,69 @@ def run(src, dst, spec, method_register):
         elif line.startswith("DATAMATIC_BEGIN"):
             in_block = True
             flags = parse_flags(set(line.split()[1:]))
+        elif line.lstrip().startswith(INCLUDE):
+            raise GeneratorError(src, f"{INCLUDE} can only be used inside a datamatic block")
         else:
             out += line + "\n"
 
-    if dst.exists():
-        with dst.open() as dstfile:
-            if dstfile.read() == out:
-                print(f"No change to {dst}")
-                return False
+    return out
+
+
+def encode_output(out):
+    """
+    Returns the bytes that writing out to a file in text mode would produce.
+    """
+    if os.linesep != "\n":
+        out = out.replace("\n", os.linesep)
+    return out.encode(locale.getpreferredencoding(False))
+
+
+def write_output(dst, out, manifest=None):
+    """
+    Writes out to dst, returning False without touching the file if it is already up to date.
+    The existing file is compared by size and then by hash; if the manifest has a record
+    matching the file's current size and mtime, the file is not read at all. Changed files
+    are replaced atomically.
+    """
+    return write_data(dst, encode_output(out), manifest)
+
+
+def write_data(dst, data, manifest=None, raw=None):
+    """
+    As write_output, for output that has already been encoded. If the output was post-
+    processed, raw is the post-processor's key for it, which is recorded in the manifest.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+
+    try:
+        stat = dst.stat()
+    except FileNotFoundError:
+        stat = None
+
+    if stat is not None:
+        record = manifest.trusted_output(dst, stat) if manifest is not None else None
+        trusted = record is not None
+        if trusted:
+            unchanged = record["sha256"] == digest
+        else:
+            unchanged = stat.st_size == len(data) and fileio.file_digest(dst) == digest
+
+        if unchanged:
+            if manifest is not None and (not trusted or record.get("raw") != raw):
+                manifest.set_output(dst, stat, digest, raw)
+            return False
+
+    fileio.atomic_write(dst, data, mode=stat.st_mode & 0o7777 if stat is not None else None)
+    if manifest is not None:
+        manifest.set_output(dst, dst.stat(), digest, raw)
+    return True
+
 
-    with dst.open("w") as dstfile:
-        dstfile.write(out)
+def run(src, dst, spec, method_register, cache=None, options=None):
+    out = render(src, read_template(src), spec, method_register, cache, options)
+    if not write_output(dst, out):
+        print(f"No change to {dst}")
+        return False
 
     print(f"Generated file {dst}")
     return True
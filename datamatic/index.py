@@ -0,0 +1,110 @@
+"""
+Precomputed lookups over the components and attributes of a spec, available to functions
+as ctx.index. Each lookup is built the first time it is used and then reused by every
+token in every template rendered with the same spec and flags.
+"""
+from . import utilities
+
+
+class SpecIndex:
+    """
+    Lookups over the components (and their attributes) that match a set of flags.
+    """
+    def __init__(self, spec, flags):
+        self.spec = spec
+        self.flags = flags
+        self._components = None
+        self._positions = None
+        self._attributes = {}
+        self._attr_positions = {}
+        self._columns = {}
+        self._components_by = {}
+        self._attributes_by = {}
+
+    @property
+    def components(self):
+        """
+        The components that match the flags, in spec order.
+        """
+        if self._components is None:
+            self._components = utilities.filter_flags(self.spec["components"], self.flags)
+        return self._components
+
+    def attributes(self, comp):
+        """
+        The attributes of the given component that match the flags, in spec order.
+        """
+        key = id(comp)
+        if key not in self._attributes:
+            self._attributes[key] = (comp, utilities.filter_flags(comp["attributes"], self.flags))
+        return self._attributes[key][1]
+
+    def column(self, comp, field):
+        """
+        The value of the given field for each of the component's filtered attributes.
+        """
+        key = (id(comp), field)
+        if key not in self._columns:
+            self._columns[key] = [attr[field] for attr in self.attributes(comp)]
+        return self._columns[key]
+
+    def position(self, comp):
+        """
+        The index of the given component in the filtered component list, or None if it is
+        not in the list.
+        """
+        if self._positions is None:
+            self._positions = {id(c): i for i, c in enumerate(self.components)}
+        return _find(self._positions, self.components, comp)
+
+    def attr_position(self, comp, attr):
+        """
+        The index of the given attribute in the component's filtered attribute list, or None
+        if it is not in the list.
+        """
+        attrs = self.attributes(comp)
+        key = id(comp)
+        if key not in self._attr_positions:
+            self._attr_positions[key] = {id(a): i for i, a in enumerate(attrs)}
+        return _find(self._attr_positions[key], attrs, attr)
+
+    def components_by(self, field):
+        """
+        A dict mapping each value of the given field to the first component with that value.
+        Components without the field are left out.
+        """
+        if field not in self._components_by:
+            lookup = {}
+            for comp in self.components:
+                if field in comp:
+                    lookup.setdefault(comp[field], comp)
+            self._components_by[field] = lookup
+        return self._components_by[field]
+
+    def attributes_by(self, field):
+        """
+        A dict mapping each value of the given field to a list of (component, attribute)
+        pairs for every attribute with that value. Attributes without the field are left out.
+        """
+        if field not in self._attributes_by:
+            lookup = {}
+            for comp in self.components:
+                for attr in self.attributes(comp):
+                    if field in attr:
+                        lookup.setdefault(attr[field], []).append((comp, attr))
+            self._attributes_by[field] = lookup
+        return self._attributes_by[field]
+
+
+def _find(positions, objs, obj):
+    """
+    Looks the object up by identity, falling back to equality for objects that are not in
+    the spec itself, such as copies.
+    """
+    position = positions.get(id(obj))
+    if position is not None:
+        return position
+    try:
+        return objs.index(obj)
+    except ValueError:
+        return None
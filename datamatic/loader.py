@@ -0,0 +1,197 @@
+"""
+Reads component specs from disk. A spec can be given as a single JSON file, a JSON Lines
+file where each line is a fragment, or a directory of JSON/JSON Lines files. Each file is
+parsed on its own and the fragments are merged in a deterministic (sorted path) order.
+
+A fragment is either a dict containing a "components" list (along with any other top level
+keys such as "flag_defaults"), a list of components, or a single component.
+"""
+import collections
+import hashlib
+import json
+import pathlib
+import pickle
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from . import fileio
+
+
+# How often files were found in the cache, for reporting.
+stats = collections.Counter()
+
+
+class FileCache:
+    """
+    The parsed fragments of each file of a spec, keyed on path and invalidated when the size
+    or mtime of the file changes. With a cache directory, the fragments are kept between
+    runs in a single pickle per spec, which loads much faster than parsing every file, so
+    editing one file of a spec only parses that file again.
+    """
+    def __init__(self, spec_path: pathlib.Path, cache_dir: Optional[pathlib.Path] = None):
+        self.path = None
+        self.entries = {}
+        self.used = {}
+        self.changed = False
+        self.lock = threading.Lock()
+
+        if cache_dir is not None:
+            name = hashlib.sha256(str(spec_path.resolve()).encode()).hexdigest()[:16]
+            self.path = cache_dir / "spec_files" / f"{name}.pickle"
+            try:
+                with self.path.open("rb") as handle:
+                    self.entries = pickle.load(handle)
+            except (OSError, EOFError, ValueError, TypeError, pickle.UnpicklingError):
+                pass  # A missing or corrupt cache only costs a slower run
+
+    def load(self, path: pathlib.Path):
+        """
+        Returns the list of fragments in the given file. The returned objects are shared
+        with the cache, so callers must not mutate them.
+        """
+        stat = path.stat()
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self.entries.get(str(path))
+        if cached is not None and cached[0] == key:
+            with self.lock:
+                stats["hits"] += 1
+                self.used[str(path)] = cached
+            return cached[1]
+        read_at = time.time_ns()
+
+        with path.open() as handle:
+            if path.suffix == ".jsonl":
+                fragments = [json.loads(line) for line in handle if line.strip()]
+            else:
+                fragments = [json.load(handle)]
+
+        with self.lock:
+            stats["misses"] += 1
+            if read_at - stat.st_mtime_ns > fileio.RACY_NS:
+                self.used[str(path)] = (key, fragments)
+                self.changed = True
+        return fragments
+
+    def trusted_key(self, path: pathlib.Path):
+        """
+        Returns the (mtime_ns, size) the given file was loaded at, or None if it was not
+        loaded or was modified too recently for that to show it has not changed since.
+        """
+        entry = self.used.get(str(path))
+        return tuple(entry[0]) if entry is not None else None
+
+    def save(self):
+        """
+        Saves the entries for the files read since the cache was loaded, dropping files
+        that are no longer part of the spec.
+        """
+        if self.path is None or not (self.changed or self.used.keys() != self.entries.keys()):
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fileio.atomic_write(self.path, pickle.dumps(self.used, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def copy_component(comp):
+    """
+    Copies a component and its attributes so that flag defaults can be filled in without
+    modifying cached data.
+    """
+    if not isinstance(comp, dict):
+        return comp
+    new_comp = dict(comp)
+    if isinstance(comp.get("attributes"), list):
+        new_comp["attributes"] = [dict(attr) if isinstance(attr, dict) else attr for attr in comp["attributes"]]
+    return new_comp
+
+
+def merge(fragments):
+    """
+    Combines a list of fragments into a single spec. Top level keys other than "components"
+    may appear in more than one fragment, but must have the same value each time.
+    """
+    spec = {"components": []}
+    for fragment in fragments:
+        if isinstance(fragment, list):
+            spec["components"].extend(copy_component(comp) for comp in fragment)
+        elif isinstance(fragment, dict) and "components" in fragment:
+            for key, value in fragment.items():
+                if key == "components":
+                    if not isinstance(value, list):
+                        spec["components"] = value  # Let the validator report this
+                        continue
+                    spec["components"].extend(copy_component(comp) for comp in value)
+                elif key in spec and spec[key] != value:
+                    raise RuntimeError(f"Conflicting values for '{key}' across spec files")
+                else:
+                    spec[key] = value
+        else:
+            spec["components"].append(copy_component(fragment))
+    return spec
+
+
+def spec_files(directory: pathlib.Path):
+    """
+    Returns all spec files within the given directory in the order they are merged.
+    """
+    files = [
+        path for path in directory.glob("**/*")
+        if path.suffix in {".json", ".jsonl"} and path.is_file()
+    ]
+    return sorted(files, key=lambda path: path.relative_to(directory).as_posix())
+
+
+def component_count(fragment):
+    """
+    Returns the number of components merge takes from the given fragment.
+    """
+    if isinstance(fragment, list):
+        return len(fragment)
+    if isinstance(fragment, dict) and "components" in fragment:
+        return len(fragment["components"]) if isinstance(fragment["components"], list) else 0
+    return 1
+
+
+def read_spec(path: pathlib.Path, cache_dir: Optional[pathlib.Path] = None):
+    """
+    Reads the spec at the given path, which may be a JSON file, a JSON Lines file or a
+    directory containing either. If a cache directory is given, unchanged files are not
+    parsed again, see FileCache.
+    """
+    return read_spec_sources(path, cache_dir)[0]
+
+
+def read_spec_sources(path: pathlib.Path, cache_dir: Optional[pathlib.Path] = None):
+    """
+    Reads the spec like read_spec, and also returns a (file, key, count) tuple for each of
+    its files in the order they are merged, where key is the file's trusted (mtime_ns, size)
+    from FileCache.trusted_key and count is the number of components taken from the file.
+    """
+    file_cache = FileCache(path, cache_dir)
+    if not path.is_dir():
+        fragments = file_cache.load(path)
+        file_cache.save()
+        if path.suffix != ".jsonl" and isinstance(fragments[0], dict):
+            # A single JSON file is the whole spec, keep it as it is.
+            spec = dict(fragments[0])
+            count = 0
+            if isinstance(spec.get("components"), list):
+                spec["components"] = [copy_component(comp) for comp in spec["components"]]
+                count = len(spec["components"])
+            return spec, [(path, file_cache.trusted_key(path), count)]
+        count = sum(component_count(fragment) for fragment in fragments)
+        return merge(fragments), [(path, file_cache.trusted_key(path), count)]
+
+    # Threads overlap reading the files, but parsing them is held to one core by the GIL. A
+    # process pool would spend as long pickling the parsed files back as it saves parsing
+    # them, and FileCache means that usually only changed files are parsed anyway.
+    files = spec_files(path)
+    with ThreadPoolExecutor() as pool:
+        per_file = list(pool.map(file_cache.load, files))
+    file_cache.save()
+    sources = [
+        (file, file_cache.trusted_key(file), sum(component_count(fragment) for fragment in fragments))
+        for file, fragments in zip(files, per_file)
+    ]
+    return merge(fragment for fragments in per_file for fragment in fragments), sources
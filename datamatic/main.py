@@ -2,18 +2,69 @@
 Command line parser for datamatic.
 """
 import os
-import pathlib
 import json
+import collections
+import fnmatch
+import pathlib
 import shutil
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from . import validator, generator, method_register, loader, cache, fileio, dependencies, archive, postprocess
+from .options import Options
+from .report import Report
 
-from . import validator, generator, method_register
 
+def load_spec(specfile: pathlib.Path, cache_dir: Optional[pathlib.Path] = None, run_report: Optional[Report] = None):
+    """
+    Reads, fills in and validates the spec. If a cache directory is given, the components
+    of each spec file are not validated again if the file, the flag defaults and the
+    validator have not changed since they were last found to be valid.
+    """
+    if run_report is None:
+        run_report = Report()
 
-def load_spec(specfile: pathlib.Path):
-    with specfile.open() as specfile_handle:
-        spec = json.load(specfile_handle)
-    fill_flag_defaults(spec)
-    validator.run(spec)
+    with run_report.phase("spec_load"):
+        before = loader.stats.copy()
+        spec, sources = loader.read_spec_sources(specfile, cache_dir)
+        fill_flag_defaults(spec)
+        run_report.add_cache_stats(
+            {"spec_file": loader.stats["hits"] - before["hits"]},
+            {"spec_file": loader.stats["misses"] - before["misses"]}
+        )
+
+    with run_report.phase("validation"):
+        if cache_dir is None:
+            validator.run(spec)
+            return spec
+
+        validated = cache.load_validated(cache_dir / "validated.json")
+        base = [fileio.file_digest(validator.__file__), dependencies.digest(spec.get("flag_defaults"))]
+        valid = set()
+        unchecked = []
+        start = 0
+        for file, key, count in sources:
+            indices = range(start, start + count)
+            start += count
+            if key is None:
+                continue  # Modified too recently to record
+            record = [*base, *key]
+            if validated.get(str(file.resolve())) == record:
+                valid.update(indices)
+            else:
+                unchecked.append((str(file.resolve()), record, indices))
+
+        hits = len(valid)
+        try:
+            validator.run(spec, valid)
+        finally:
+            run_report.add_cache_stats({"validation": hits}, {"validation": start - hits})
+            # Files whose components were all valid are recorded even if others were not
+            newly_valid = {name: record for name, record, indices in unchecked if all(i in valid for i in indices)}
+            if newly_valid:
+                validated.update(newly_valid)
+                cache.save_validated(cache_dir / "validated.json", validated)
     return spec
 
 
@@ -30,59 +81,483 @@ def fill_flag_defaults(spec):
             attr["flags"] = {**defaults, **attr_flags}
 
 
-def main_inplace(specfile: pathlib.Path, directory: pathlib.Path):
+class Session:
+    """
+    State that can be shared between several runs in the same process, such as the jobs in
+    a batch. Each directory is scanned once, each template file is read once, each plugin
+    directory is imported once and each spec is loaded once. Directories are not scanned
+    again, so files created by one run are not seen by later runs over the same directory.
+    """
+    def __init__(self, run_report: Optional[Report] = None):
+        self.report = run_report if run_report is not None else Report()
+        self.scans = {}
+        self.templates = {}
+        self.registers = {}
+        self.specs = {}
+        self.render_caches = {}
+        self.result_stores = {}
+        self.chunk_stores = {}
+        self.code_digests = {}
+
+    def files(self, root: pathlib.Path):
+        """
+        Returns every file under root, sorted.
+        """
+        if root not in self.scans:
+            with self.report.phase("scan"):
+                self.scans[root] = sorted(path for path in root.glob("**/*") if path.is_file())
+        return self.scans[root]
+
+    def glob(self, root: pathlib.Path, pattern: str):
+        return [path for path in self.files(root) if fnmatch.fnmatch(path.name, pattern)]
+
+    def read_template(self, path: pathlib.Path):
+        if path not in self.templates:
+            self.templates[path] = generator.read_template(path)
+        return self.templates[path]
+
+    def register(self, root: pathlib.Path):
+        """
+        Returns a method register with the builtins and the dmx files under root loaded.
+        """
+        if root not in self.registers:
+            files = self.glob(root, "*.dmx.py")
+            with self.report.phase("plugin_import"):
+                reg = method_register.MethodRegister()
+                reg.load_builtins()
+                for file in files:
+                    reg.load_dmx_file(file)
+            self.registers[root] = reg
+        return self.registers[root]
+
+    def spec(self, specfile: pathlib.Path, cache_dir: Optional[pathlib.Path] = None):
+        if specfile not in self.specs:
+            self.specs[specfile] = load_spec(specfile, cache_dir, self.report)
+        return self.specs[specfile]
+
+    def render_cache(self, specfile: pathlib.Path, root: pathlib.Path):
+        """
+        Rendered blocks can be shared by runs with the same spec and plugins.
+        """
+        key = (specfile, root)
+        if key not in self.render_caches:
+            self.render_caches[key] = cache.RenderCache()
+        return self.render_caches[key]
+
+    def result_store(self, specfile: pathlib.Path, root: pathlib.Path, options: Options):
+        """
+        Returns the shared result store for runs with this spec and these plugins, or None
+        if there is no shared cache.
+        """
+        if options.shared_cache is None:
+            return None
+        key = (specfile, root, options.shared_cache)
+        if key not in self.result_stores:
+            base = dependencies.digest([dependencies.digest(self.spec(specfile)), self.code_digest(root)])
+            self.result_stores[key] = cache.ResultStore(options.shared_cache, base)
+        return self.result_stores[key]
+
+    def chunk_store(self, specfile: pathlib.Path, root: pathlib.Path, options: Options):
+        """
+        Returns the chunk store for runs with this spec and these plugins, or None if this is
+        not an --only-component run.
+        """
+        if options.only_components is None:
+            return None
+        spec = self.spec(specfile)
+        names = [comp.get("name") for comp in spec["components"]]
+        unknown = [name for name in options.only_components if name not in names]
+        if unknown:
+            raise RuntimeError(f"Components {unknown} are not in the spec")
+
+        cache_dir = options.cache_dir_for(root)
+        key = (specfile, root, cache_dir)
+        if key not in self.chunk_stores:
+            base = dependencies.digest([
+                self.code_digest(root),
+                {field: value for field, value in spec.items() if field != "components"},
+                dependencies.Fingerprints(spec).get("structure"),
+                names
+            ])
+            unique = {name for name, count in collections.Counter(names).items() if count == 1 and isinstance(name, str)}
+            components = {
+                comp["name"]: dependencies.digest(comp) for comp in spec["components"] if comp.get("name") in unique
+            }
+            self.chunk_stores[key] = cache.ChunkStore(cache_dir, base, components)
+        return self.chunk_stores[key]
+
+    def code_digest(self, root: pathlib.Path):
+        """
+        A hash of the datamatic sources and the dmx files under root.
+        """
+        if root not in self.code_digests:
+            code = dependencies.PACKAGE_SOURCES + self.glob(root, "*.dmx.py")
+            self.code_digests[root] = dependencies.digest([(str(path), fileio.file_digest(path)) for path in code])
+        return self.code_digests[root]
+
+    def save_report(self, path: pathlib.Path):
+        for render_cache in self.render_caches.values():
+            self.report.add_cache_stats(render_cache.hits, render_cache.misses)
+        self.report.save(path)
+
+
+def is_up_to_date(srcfile, dstfile, lines, reg, manifest, fingerprints, command=None):
+    """
+    Returns True if the template can be skipped because neither it nor anything it depends
+    on has changed since the last run, and records its dependencies for the next run. command
+    is the post-process command for dstfile, if there is one.
+    """
+    source = dependencies.digest(lines)
+    record = manifest.get_template(srcfile)
+    if (
+        record is not None
+        and record["source"] == source
+        and record["dst"] == str(dstfile)
+        and record.get("post_process") == command
+        and fingerprints.unchanged(record["deps"])
+        and manifest.output_is_current(dstfile)
+    ):
+        return True
+
+    deps = dependencies.template_dependencies(srcfile, lines, reg)
+    if deps is dependencies.UNTRACKED:
+        manifest.set_template(srcfile, None)
+    else:
+        manifest.set_template(srcfile, {
+            "source": source,
+            "dst": str(dstfile),
+            "post_process": command,
+            "deps": fingerprints.all(deps)
+        })
+    return False
+
+
+def post_processor_for(options: Options, cache_dir: pathlib.Path):
+    if not options.post_process:
+        return None
+    return postprocess.PostProcessor(options.post_process, cache_dir)
+
+
+@dataclass
+class TemplateRun:
+    """
+    Renders and writes the templates of one inplace or package run. Everything after
+    options is optional:
+        manifest        templates whose dependencies have not changed are skipped
+        sink            called with each dst and encoded output instead of writing the file,
+                        and returns the number of bytes stored
+        store           a cache.ResultStore; outputs rendered by other processes are reused
+        chunk_store     a cache.ChunkStore; only the components in options.only_components
+                        and those that have changed are rendered, the rest are reused
+        post_processor  outputs are passed through it before being compared and written
+        workers         a pool from generator.worker_pool, used to render large blocks
+    """
+    session: Session
+    spec: dict
+    reg: method_register.MethodRegister
+    render_cache: cache.RenderCache
+    options: Options
+    manifest: Optional[cache.Manifest] = None
+    sink: Optional[Callable] = None
+    store: Optional[cache.ResultStore] = None
+    chunk_store: Optional[cache.ChunkStore] = None
+    post_processor: Optional[postprocess.PostProcessor] = None
+    workers: Optional[object] = None
+
+    def __post_init__(self):
+        self.fingerprints = dependencies.Fingerprints(self.spec)
+
+    def render_templates(self, pool, targets, log):
+        """
+        Renders each (src, dst) pair in targets. Templates are read and outputs are
+        post-processed, compared and written on the file pool, so only rendering happens on
+        this thread. Returns the number of files that were written.
+        """
+        run_report = self.session.report
+        dsts = dict(targets)
+        writes = []
+        saves = []
+        for srcfile, lines in pool.read_ahead(dsts, self.session.read_template):
+            dstfile = dsts[srcfile]
+            manifest = self.manifest
+            command = self.post_processor.command_for(dstfile) if self.post_processor is not None else None
+            if manifest is not None and is_up_to_date(
+                srcfile, dstfile, lines, self.reg, manifest, self.fingerprints, command
+            ):
+                self.render_cache.hits["template"] += 1
+                writes.append((srcfile, dstfile, None, 0.0))
+                continue
+
+            if self.manifest is not None:
+                self.render_cache.misses["template"] += 1
+            start = time.perf_counter()
+            with run_report.phase("render"):
+                out, chunks = self.render(srcfile, lines)
+            if chunks is not None:
+                saves.append(pool.submit(self.chunk_store.save, srcfile, *chunks))
+            if manifest is not None and self.options.only_components is not None:
+                # Reused components may read others that have changed, so the output is only
+                # known to be current once a full run has rendered it
+                manifest.set_template(srcfile, None)
+            render_seconds = time.perf_counter() - start
+            writes.append((srcfile, dstfile, pool.submit(self.write, srcfile, dstfile, out), render_seconds))
+
+        for future in saves:
+            future.result()
+
+        count = 0
+        for srcfile, dstfile, write_future, render_seconds in writes:
+            size = write_future.result() if write_future is not None else None
+            if size is not None:
+                run_report.add_file(srcfile, dstfile, "written", render_seconds, size)
+                message = f"Generated file {dstfile}"
+                count += 1
+            else:
+                status = "unchanged" if write_future is not None else "skipped"
+                run_report.add_file(srcfile, dstfile, status, render_seconds)
+                message = f"No change to {dstfile}"
+            if not self.options.quiet:
+                log.append(message)
+        return count
+
+    def partials(self, srcfile, lines):
+        return [
+            (str(path), self.fingerprints.get(f"file:{path}"))
+            for path in dependencies.partial_files(srcfile, lines)
+        ]
+
+    def render(self, srcfile, lines):
+        """
+        Returns the rendered output, and the (key, chunks) to save to the chunk store if
+        there is one.
+        """
+        if self.chunk_store is not None:
+            key = self.chunk_store.key(lines, self.partials(srcfile, lines))
+            reuse = self.chunk_store.reuse(srcfile, key, self.options.only_components)
+            if reuse is None:
+                self.render_cache.misses["chunk"] += 1
+            else:
+                self.render_cache.hits["chunk"] += 1
+            chunks = []
+            out = generator.render(
+                srcfile, lines, self.spec, self.reg, self.render_cache, self.options, chunks, reuse, self.workers
+            )
+            return out, (key, chunks)
+
+        if self.store is None:
+            return self._render(srcfile, lines), None
+
+        key = self.store.key(srcfile, lines, self.partials(srcfile, lines))
+        with self.store.lock(key):
+            out = self.store.get(key)
+            if out is not None:
+                self.render_cache.hits["result"] += 1
+                return out, None
+            self.render_cache.misses["result"] += 1
+            out = self._render(srcfile, lines)
+            self.store.put(key, out)
+        return out, None
+
+    def _render(self, srcfile, lines):
+        return generator.render(
+            srcfile, lines, self.spec, self.reg, self.render_cache, self.options, workers=self.workers
+        )
+
+    def write(self, srcfile, dstfile, out):
+        """
+        Post-processes and writes the output, returning its size, or None if dstfile was
+        already up to date. Each output is written while holding a lock on it, so
+        concurrent datamatic processes writing the same file take turns.
+        """
+        run_report = self.session.report
+        data = generator.encode_output(out)
+        command = self.post_processor.command_for(dstfile) if self.post_processor is not None else None
+        raw = None
+        if command is not None:
+            # Run where the template is, as dstfile may be inside an archive
+            raw = self.post_processor.key(srcfile.parent, command, data)
+            if self.manifest is not None and self.manifest.raw_is_current(dstfile, raw):
+                run_report.count("post_process_skipped")
+                return None
+            with run_report.phase("post_process"):
+                data = self.post_processor.run(dstfile, srcfile.parent, command, data, raw)
+            run_report.count("post_process_runs")
+
+        with run_report.phase("write"):
+            if self.sink is not None:
+                return self.sink(dstfile, data)
+            with fileio.FileLock(fileio.lock_path(dstfile)):
+                if generator.write_data(dstfile, data, self.manifest, raw):
+                    return dstfile.stat().st_size
+            return None
+
+
+def main_inplace(
+    specfile: pathlib.Path,
+    directory: pathlib.Path,
+    options: Optional[Options] = None,
+    session: Optional[Session] = None
+):
     """
     Entry point for the inplace tool.
     """
-    spec = load_spec(specfile)
+    if options is None:
+        options = Options()
+    owns_session = session is None
+    if owns_session:
+        session = Session()
+    spec = session.spec(specfile, options.cache_dir_for(directory))
+    reg = session.register(directory)
+    render_cache = session.render_cache(specfile, directory)
 
-    reg = method_register.MethodRegister()
-    reg.load_builtins()
-    reg.load_from_dmx(directory)
+    targets = [
+        (srcfile, srcfile.parent / srcfile.name.replace(".dm.", "."))
+        for srcfile in session.glob(directory, "*.dm.*")
+        if options.only_template is None
+        or fnmatch.fnmatch(srcfile.relative_to(directory).as_posix(), options.only_template)
+    ]
 
-    count = 0
-    for srcfile in directory.glob("**/*.dm.*"):
-        dstfile = srcfile.parent / srcfile.name.replace(".dm.", ".")
-        if generator.run(srcfile, dstfile, spec, reg):
-            count += 1
+    manifest = cache.Manifest(options.cache_dir_for(directory) / "manifest.json")
+    log = []
+    with generator.worker_pool(spec, reg, options) as workers, fileio.FilePool() as pool:
+        run = TemplateRun(
+            session, spec, reg, render_cache, options,
+            manifest=manifest,
+            store=session.result_store(specfile, directory, options),
+            chunk_store=session.chunk_store(specfile, directory, options),
+            post_processor=post_processor_for(options, options.cache_dir_for(directory)),
+            workers=workers
+        )
+        count = run.render_templates(pool, targets, log)
+    manifest.save()
 
-    print(f"Done! Generated {count} files")
+    log.append(f"Done! Generated {count} files")
+    if summary := render_cache.summary():
+        log.append(summary)
+    print("\n".join(log))
+    if owns_session and options.report is not None:
+        session.save_report(options.report)
     return count
 
 
-def main_package(specfile: pathlib.Path, src: pathlib.Path, dst: pathlib.Path):
+def main_package(
+    specfile: pathlib.Path,
+    src: pathlib.Path,
+    dst: pathlib.Path,
+    options: Optional[Options] = None,
+    session: Optional[Session] = None
+):
     """
     Entry point for the package tool.
     """
-    spec = load_spec(specfile)
+    if options is None:
+        options = Options()
+    owns_session = session is None
+    if owns_session:
+        session = Session()
+    cache_dir = options.cache_dir_for(src)
+    spec = session.spec(specfile, cache_dir)
+    reg = session.register(src)
+    render_cache = session.render_cache(specfile, src)
+
+    if archive.is_archive(dst):
+        archive_writer = archive.ArchiveWriter(dst)
+    else:
+        archive_writer = None
+        if dst.exists():
+            print("Deleting old dst directory")
+            shutil.rmtree(str(dst))
+        print("Creating new dst directory")
+        os.mkdir(str(dst))
+
+    def copy(srcfile, dstfile):
+        with session.report.phase("copy"):
+            if archive_writer is not None:
+                archive_writer.add_file(dstfile.name, srcfile)
+            else:
+                fileio.copy_file(srcfile, dstfile)
+        session.report.count("files_copied")
+
+    def store(dstfile, data):
+        archive_writer.add_bytes(dstfile.name, data)
+        return len(data)
+
+    ignore = set(session.glob(src, "*.dmx.py")) | set(session.glob(src, "*.dmp.*")) | set(session.glob(src, "*.pyc"))
+    templates = set(session.glob(src, "*.dm.*"))
+    targets = []
+    log = []
+    with generator.worker_pool(spec, reg, options) as workers, fileio.FilePool() as pool:
+        copies = []
+        for srcfile in session.files(src):
+            if srcfile in ignore or cache_dir in srcfile.parents:
+                continue  # Ignore plugins, partials and the cache
+
+            if srcfile in templates:
+                targets.append((srcfile, dst / srcfile.name.replace(".dm.", ".")))
+            else:
+                copies.append(pool.submit(copy, srcfile, dst / srcfile.name))
+
+        run = TemplateRun(
+            session, spec, reg, render_cache, options,
+            sink=store if archive_writer is not None else None,
+            store=session.result_store(specfile, src, options),
+            chunk_store=session.chunk_store(specfile, src, options),
+            post_processor=post_processor_for(options, cache_dir),
+            workers=workers
+        )
+        count = run.render_templates(pool, targets, log)
+        for future in copies:
+            future.result()
+
+    if archive_writer is not None:
+        with session.report.phase("write"):
+            archive_writer.close()
+
+    log.append(f"Done! Generated {count} files")
+    if summary := render_cache.summary():
+        log.append(summary)
+    print("\n".join(log))
+    if owns_session and options.report is not None:
+        session.save_report(options.report)
+    return count
+
+
+def load_jobs(jobfile: pathlib.Path):
+    """
+    Reads a batch file, which is a JSON dict with a "jobs" list. Each job has a "mode" of
+    "inplace" or "package" and a "spec". Inplace jobs have a "dir", and package jobs have a
+    "src" and "dst". Relative paths are relative to the batch file.
+    """
+    with jobfile.open() as handle:
+        data = json.load(handle)
 
-    reg = method_register.MethodRegister()
-    reg.load_builtins()
-    reg.load_from_dmx(src)
+    jobs = []
+    for index, job in enumerate(data.get("jobs", [])):
+        mode = job.get("mode")
+        keys = {"inplace": ["spec", "dir"], "package": ["spec", "src", "dst"]}.get(mode)
+        if keys is None:
+            raise RuntimeError(f"Job {index} has invalid mode {mode!r}, must be 'inplace' or 'package'")
+        missing = [key for key in keys if key not in job]
+        if missing:
+            raise RuntimeError(f"Job {index} is missing {missing}")
+        jobs.append({"mode": mode, **{key: jobfile.parent / job[key] for key in keys}})
+    return jobs
 
-    if dst.exists():
-        print("Deleting old dst directory")
-        shutil.rmtree(str(dst))
-    print("Creating new dst directory")
-    os.mkdir(str(dst))
 
+def main_batch(jobfile: pathlib.Path, options: Optional[Options] = None):
+    """
+    Entry point for the batch tool. Runs every job in the batch file in this process,
+    sharing scanned directories, templates, plugins and specs between them.
+    """
+    if options is None:
+        options = Options()
+    session = Session()
     count = 0
-    ignore = set(src.glob("**/*.dmx.py")) | set(src.glob("**/*.pyc"))
-    templates = set(src.glob("**/*.dm.*"))
-    for srcfile in src.glob("**/*"):
-        if srcfile in ignore:
-            continue  # Ignore plugins
-
-        if srcfile in templates:
-            dstfile = dst / srcfile.name.replace(".dm.", ".")
-            if generator.run(srcfile, dstfile, spec, reg):
-                count += 1
+    for job in load_jobs(jobfile):
+        if job["mode"] == "inplace":
+            count += main_inplace(job["spec"], job["dir"], options, session)
         else:
-            dstfile = dst / srcfile.name
-            try:
-                shutil.copy(srcfile, dstfile)
-            except PermissionError:
-                pass
-
-    print(f"Done! Generated {count} files")
+            count += main_package(job["spec"], job["src"], job["dst"], options, session)
+    if options.report is not None:
+        session.save_report(options.report)
     return count
@@ -7,8 +7,6 @@ import pathlib
 import importlib.util
 from functools import partialmethod
 
-from . import utilities
-
 
 class MethodRegister:
     def __init__(self):
@@ -16,8 +14,9 @@ class MethodRegister:
 
     def register_method(self, function, namespace):
         fn_name = function.__name__
-        if (namespace, fn_name) in self.methods:
-            raise RuntimeError(f"An implementation already exists for {namespace}::{fn_name}")
+        token_namespace = "Attr" if namespace == "AttrBatch" else namespace
+        if self.find(token_namespace, fn_name) is not None:
+            raise RuntimeError(f"An implementation already exists for {token_namespace}::{fn_name}")
         self.methods[namespace, fn_name] = function
         return function
 
@@ -25,6 +24,37 @@ class MethodRegister:
     attrmethod = partialmethod(register_method, namespace="Attr")
     globalmethod = partialmethod(register_method, namespace="Global")
 
+    # Batch attrmethods are called once per line with the list of attributes matching the
+    # flags, and return one string per attribute. They are used in templates like any other
+    # Attr function.
+    attrbatch = partialmethod(register_method, namespace="AttrBatch")
+
+    def find(self, namespace, function_name):
+        """
+        Returns the registered function for the token, including batch functions, or None.
+        """
+        function = self.methods.get((namespace, function_name))
+        if function is None and namespace == "Attr":
+            function = self.methods.get(("AttrBatch", function_name))
+        return function
+
+    def get_batch(self, function_name):
+        return self.methods.get(("AttrBatch", function_name))
+
+    @staticmethod
+    def reads(*fields):
+        """
+        Declares the spec fields a function depends on, for example "Comp::name",
+        "Attr::type" or "Attr::*" for every attribute field. Which components and attributes
+        exist, and their flags, are always assumed to be read. Templates that only use
+        declared functions are skipped on later runs if none of those fields change;
+        templates using any undeclared function are always re-rendered.
+        """
+        def decorator(function):
+            function.reads = frozenset(fields)
+            return function
+        return decorator
+
     def get(self, namespace, function_name):
         if (namespace, function_name) in self.methods:
             return self.methods[namespace, function_name]
@@ -41,53 +71,64 @@ class MethodRegister:
 
         @self.compmethod
         @self.attrmethod
+        @self.reads()
         def if_nth_else(ctx, n: int, yes_token: str, no_token:str) -> str:
-            try:
-                if ctx.namespace == "Comp":
-                    comps = utilities.filter_flags(ctx.spec["components"], ctx.flags)
-                    return yes_token if ctx.comp == comps[n] else no_token
-                attrs = utilities.filter_flags(ctx.comp["attributes"], ctx.flags)
-                return yes_token if ctx.attr == attrs[n] else no_token
-            except IndexError:
+            if ctx.namespace == "Comp":
+                count = len(ctx.index.components)
+            else:
+                count = len(ctx.index.attributes(ctx.comp))
+            if not -count <= n < count:
                 return no_token
+            return yes_token if ctx.position == n % count else no_token
 
         @self.compmethod
         @self.attrmethod
+        @self.reads()
         def if_first(ctx, token):
             return if_nth_else(ctx, 0, token, "")
 
         @self.compmethod
         @self.attrmethod
+        @self.reads()
         def if_not_first(ctx, token):
             return if_nth_else(ctx, 0, "", token)
 
         @self.compmethod
         @self.attrmethod
+        @self.reads()
         def if_last(ctx, token):
             return if_nth_else(ctx, -1, token, "")
 
         @self.compmethod
         @self.attrmethod
+        @self.reads()
         def if_not_last(ctx, token):
             return if_nth_else(ctx, -1, "", token)
 
         @self.compmethod
+        @self.reads()
         def attr_count(ctx):
-            attrs = utilities.filter_flags(ctx.comp["attributes"], ctx.flags)
-            return str(len(attrs))
+            return str(len(ctx.index.attributes(ctx.comp)))
 
         @self.compmethod
+        @self.reads("Attr::*")
         def attr_list(ctx, field, separator, format="{}"):
-            attrs = utilities.filter_flags(ctx.comp["attributes"], ctx.flags)
+            attrs = ctx.index.attributes(ctx.comp)
             return separator.join(format.format(attr[field]) for attr in attrs)
 
+    def load_dmx_file(self, file: pathlib.Path):
+        """
+        Imports the given dmx file and runs its main function to load up custom functions.
+        """
+        spec = importlib.util.spec_from_file_location(file.stem, file)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        module.main(self)
+
     def load_from_dmx(self, directory: pathlib.Path):
         """
         A function that scans the given directory for dmx files, and runs the
         main function in each to load up custom functions.
         """
         for file in directory.glob("**/*.dmx.py"):
-            spec = importlib.util.spec_from_file_location(file.stem, file)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
-            module.main(self)
+            self.load_dmx_file(file)
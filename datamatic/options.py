@@ -0,0 +1,46 @@
+"""
+Settings that control how datamatic renders files, independent of what is being rendered.
+"""
+import pathlib
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class Options:
+    # Number of worker processes used to render a single large block. 1 disables this, and
+    # is the default as functions with side effects would not see each other's effects.
+    workers: int = 1
+
+    # Blocks covering at least this many components are rendered on the worker pool.
+    parallel_threshold: int = 256
+
+    # Where information is kept between runs. Defaults to a ".datamatic" directory in the
+    # directory being scanned.
+    cache_dir: Optional[pathlib.Path] = None
+
+    # Don't print a line for every generated file.
+    quiet: bool = False
+
+    # A directory shared by every datamatic process that may render the same templates, such
+    # as parallel build targets over overlapping directories. Rendered outputs are stored here
+    # so that a template is only rendered once.
+    shared_cache: Optional[pathlib.Path] = None
+
+    # If set, only templates whose path relative to the scanned directory matches this glob
+    # are rendered by inplace runs.
+    only_template: Optional[str] = None
+
+    # If set, only these components are rendered again; the output of the other components
+    # is reused from the last run where possible, see cache.ChunkStore.
+    only_components: Optional[list[str]] = None
+
+    # Maps an output extension such as ".cpp" to a command, such as "clang-format", that
+    # outputs with that extension are passed through before being written.
+    post_process: dict = field(default_factory=dict)
+
+    # If set, a JSON report of timings and statistics is saved here at the end of the run.
+    report: Optional[pathlib.Path] = None
+
+    def cache_dir_for(self, root: pathlib.Path) -> pathlib.Path:
+        return self.cache_dir if self.cache_dir is not None else root / ".datamatic"
@@ -0,0 +1,78 @@
+"""
+Runs generated files through a command chosen by their extension, such as clang-format,
+before they are compared with the existing file and written. Results are cached in the
+cache directory, so a command is only run on output it has not seen before.
+"""
+import hashlib
+import pathlib
+import shlex
+import subprocess
+
+from . import fileio
+
+
+class PostProcessor:
+    """
+    commands maps an extension such as ".cpp" to the command run for outputs with that
+    extension. Commands read the output on stdin and write the result to stdout, and are
+    run in the directory of the template so that they find their config files.
+    """
+    def __init__(self, commands: dict, directory: pathlib.Path):
+        self.commands = commands
+        self.directory = directory
+        self.configs = {}
+
+    def command_for(self, dst: pathlib.Path):
+        return self.commands.get(dst.suffix)
+
+    def config(self, cwd: pathlib.Path, command: str):
+        """
+        The contents of the config file the command's program would use, found the way
+        clang-format finds its style: the nearest .<program> or _<program> file in cwd or
+        its parents. Returns b"" if there isn't one. Other configuration is not tracked.
+        """
+        program = pathlib.Path(shlex.split(command)[0]).name
+        key = (cwd, program)
+        if key not in self.configs:
+            config = b""
+            for directory in (cwd.resolve(), *cwd.resolve().parents):
+                paths = [directory / f".{program}", directory / f"_{program}"]
+                found = next((path for path in paths if path.is_file()), None)
+                if found is not None:
+                    config = found.read_bytes()
+                    break
+            self.configs[key] = config
+        return self.configs[key]
+
+    def key(self, cwd: pathlib.Path, command: str, data: bytes):
+        """
+        A hash of the raw output, the command, the directory it is run in and the config
+        file it will use, so editing the config post-processes outputs again.
+        """
+        digest = hashlib.sha256()
+        for part in (command.encode(), str(cwd.resolve()).encode(), self.config(cwd, command), data):
+            digest.update(hashlib.sha256(part).digest())
+        return digest.hexdigest()
+
+    def run(self, dst: pathlib.Path, cwd: pathlib.Path, command: str, data: bytes, key: str):
+        """
+        Returns the result of running the command in cwd on data, which is the raw output
+        for dst.
+        """
+        path = self.directory / "post_process" / key[:2] / key
+        try:
+            return path.read_bytes()
+        except FileNotFoundError:
+            pass
+
+        try:
+            result = subprocess.run(shlex.split(command), input=data, capture_output=True, cwd=cwd)
+        except OSError as e:
+            raise RuntimeError(f"Could not run post-process command {command!r} for {dst}: {e}")
+        if result.returncode != 0:
+            stderr = result.stderr.decode(errors="replace").strip()
+            raise RuntimeError(f"Post-process command {command!r} failed for {dst}: {stderr}")
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fileio.atomic_write(path, result.stdout)
+        return result.stdout
@@ -0,0 +1,95 @@
+"""
+Collects timings and statistics about a run, which can be saved as JSON with --report.
+"""
+import collections
+import contextlib
+import json
+import pathlib
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+class Report:
+    """
+    Phase timings are summed over the whole run; phases that run on the file pool (writes
+    and copies) are summed over all threads, so can add up to more than the wall time.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = collections.defaultdict(float)
+        self.files = []
+        self.counters = collections.Counter()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.phases[name] += elapsed
+
+    def count(self, name: str, amount: int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def add_file(self, src, dst, status: str, render_seconds: float = 0.0, size: int = 0):
+        """
+        Records a generated file; status is one of "written", "unchanged" or "skipped".
+        """
+        self.files.append({
+            "src": str(src),
+            "dst": str(dst),
+            "status": status,
+            "render_seconds": render_seconds,
+            "bytes": size
+        })
+        self.count(f"files_{status}")
+        self.count("bytes_written", size)
+
+    def add_cache_stats(self, hits, misses):
+        self.hits.update(hits)
+        self.misses.update(misses)
+
+    def to_dict(self):
+        caches = {}
+        for kind in sorted(self.hits.keys() | self.misses.keys()):
+            hits, misses = self.hits[kind], self.misses[kind]
+            caches[kind] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_ratio": hits / (hits + misses) if hits + misses else None
+            }
+
+        return {
+            "total_seconds": time.perf_counter() - self.started,
+            "phases": dict(sorted(self.phases.items())),
+            "counters": dict(sorted(self.counters.items())),
+            "caches": caches,
+            "peak_memory_bytes": peak_memory(),
+            "files": self.files
+        }
+
+    def save(self, path: pathlib.Path):
+        with path.open("w") as handle:
+            json.dump(self.to_dict(), handle, indent=2)
+
+
+def peak_memory():
+    """
+    The peak resident memory of this process in bytes, or None if it cannot be found.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # Linux reports kilobytes
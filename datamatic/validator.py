@@ -46,23 +46,53 @@ def validate_attribute(attr, flag_names: Optional[set[str]]):
     validate_flags_on_object(attr, flag_names)
 
 
+def component_errors(comp, flag_names: Optional[set[str]]) -> list[str]:
+    """
+    Returns a description of every problem with the given component and its attributes.
+    """
+    try:
+        assert_type(comp, dict)
+    except InvalidSpecError as e:
+        return [str(e)]
+
+    errors = []
+    try:
+        assert_property(comp, "flags")
+        validate_flags_on_object(comp, flag_names)
+    except InvalidSpecError as e:
+        errors.append(str(e))
+
+    try:
+        assert_property(comp, "attributes")
+        assert_type(comp["attributes"], list)
+    except InvalidSpecError as e:
+        errors.append(str(e))
+        return errors
+
+    for index, attr in enumerate(comp["attributes"]):
+        try:
+            assert_type(attr, dict)
+            validate_attribute(attr, flag_names)
+        except InvalidSpecError as e:
+            errors.append(f"attributes[{index}]: {e}")
+    return errors
+
+
 def validate_component(comp, flag_names: Optional[set[str]]):
     """
     Asserts that the given component is well-formed.
     """
-    assert_property(comp, "flags")
-    validate_flags_on_object(comp, flag_names)
-
-    assert_property(comp, "attributes")
-    assert_type(comp["attributes"], list)
-    for attr in comp["attributes"]:
-        validate_attribute(attr, flag_names)
+    if errors := component_errors(comp, flag_names):
+        raise InvalidSpecError("\n".join(errors))
 
 
-def run(spec):
+def run(spec, valid: Optional[set[int]] = None):
     """
     Runs the validator against the given spec, raising an exception if there
-    is an error in the schema.
+    is an error in the schema. Every error in the spec is reported at once.
+
+    Components whose index is in valid are known to be valid and are not checked
+    again, and the indices of components found to be valid are added to it.
     """
     flag_names: Optional[set[str]] = None
     if spec_flags := spec.get("flag_defaults"):
@@ -77,7 +107,20 @@ def run(spec):
     spec_components = spec["components"]
     assert_type(spec_components, list)
 
-    for comp in spec["components"]:
-        validate_component(comp, flag_names)
+    if valid is None:
+        valid = set()
+
+    errors = []
+    for index, comp in enumerate(spec["components"]):
+        if index in valid:
+            continue
+        if comp_errors := component_errors(comp, flag_names):
+            name = comp.get("name", index) if isinstance(comp, dict) else index
+            errors.extend(f"components[{index}] ({name}): {error}" for error in comp_errors)
+        else:
+            valid.add(index)
+
+    if errors:
+        raise InvalidSpecError(f"Spec has {len(errors)} error(s):\n" + "\n".join(errors))
 
     print("Schema Valid!")
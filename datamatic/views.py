@@ -0,0 +1,109 @@
+"""
+Read-only views of the spec as seen from a block with a given set of flags. Components and
+attributes that don't match the flags are left out and flag data is hidden, without copying
+the spec. Views are what functions receive as ctx.spec, ctx.comp and ctx.attr.
+
+Only the spec, components and attributes themselves are read-only; any other values in
+the spec are the original objects and should not be modified.
+"""
+from collections.abc import Mapping
+
+from . import utilities
+
+
+class AttrView(Mapping):
+    """
+    An attribute with its flags hidden.
+    """
+    __slots__ = ("_attr",)
+
+    def __init__(self, attr):
+        self._attr = attr
+
+    def __getitem__(self, key):
+        if key == "flags":
+            raise KeyError(key)
+        return self._attr[key]
+
+    def __iter__(self):
+        return (key for key in self._attr if key != "flags")
+
+    def __len__(self):
+        return len(self._attr) - ("flags" in self._attr)
+
+    def __repr__(self):
+        return f"AttrView({dict(self)!r})"
+
+
+class CompView(Mapping):
+    """
+    A component with its flags hidden, whose "attributes" only contains the attributes
+    that match the flags. The attribute views are created the first time they are needed.
+    """
+    __slots__ = ("_comp", "_flags", "_attributes")
+
+    def __init__(self, comp, flags):
+        self._comp = comp
+        self._flags = flags
+        self._attributes = None
+
+    @property
+    def attributes(self):
+        if self._attributes is None:
+            self._attributes = tuple(
+                AttrView(attr) for attr in utilities.filter_flags(self._comp["attributes"], self._flags)
+            )
+        return self._attributes
+
+    def __getitem__(self, key):
+        if key == "flags":
+            raise KeyError(key)
+        if key == "attributes":
+            return self.attributes
+        return self._comp[key]
+
+    def __iter__(self):
+        return (key for key in self._comp if key != "flags")
+
+    def __len__(self):
+        return len(self._comp) - ("flags" in self._comp)
+
+    def __repr__(self):
+        return f"CompView({dict(self)!r})"
+
+
+class SpecView(Mapping):
+    """
+    The spec with "flag_defaults" hidden, whose "components" only contains the components
+    that match the flags.
+    """
+    __slots__ = ("_spec", "_flags", "_components")
+
+    def __init__(self, spec, flags):
+        self._spec = spec
+        self._flags = flags
+        self._components = None
+
+    @property
+    def components(self):
+        if self._components is None:
+            self._components = tuple(
+                CompView(comp, self._flags) for comp in utilities.filter_flags(self._spec["components"], self._flags)
+            )
+        return self._components
+
+    def __getitem__(self, key):
+        if key == "flag_defaults":
+            raise KeyError(key)
+        if key == "components":
+            return self.components
+        return self._spec[key]
+
+    def __iter__(self):
+        return (key for key in self._spec if key != "flag_defaults")
+
+    def __len__(self):
+        return len(self._spec) - ("flag_defaults" in self._spec)
+
+    def __repr__(self):
+        return f"SpecView({dict(self)!r})"
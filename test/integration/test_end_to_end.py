@@ -1,10 +1,16 @@
 """
 An integration test that uses a specfile and a template file.
 """
+import json
+import shlex
 import shutil
+import sys
+import tarfile
+import zipfile
 from pathlib import Path
 from typing import Optional
-from datamatic import main
+from datamatic import main, fileio
+from datamatic.options import Options
 import pytest
 
 
@@ -47,6 +53,18 @@ def test_end_to_end_inplace(src_path, tmp_path):
         assert expected.read() == actual.read()
 
 
+def test_end_to_end_inplace_with_workers(src_path, tmp_path):
+    """
+    Rendering every block on worker processes should give the same output.
+    """
+    copy_file(src_path, tmp_path, "actual.dm.cpp")
+    copy_file(src_path, tmp_path, "custom_functions.dmx.py")
+
+    specfile = src_path / "component_spec.json"
+    assert main.main_inplace(specfile, tmp_path, Options(workers=2, parallel_threshold=1)) == 1
+    assert (tmp_path / "actual.cpp").read_text() == (src_path / "expected.cpp").read_text()
+
+
 def test_file_is_not_rewritten_if_no_change(src_path, tmp_path):
     """
     Similar to the above test, except in this one we also copy the expected file into the
@@ -59,4 +77,283 @@ def test_file_is_not_rewritten_if_no_change(src_path, tmp_path):
     copy_file(src_path, tmp_path, "expected.cpp", "actual.cpp")
 
     specfile = src_path / "component_spec.json"
-    assert main.main_inplace(specfile, tmp_path) == 0
\ No newline at end of file
+    assert main.main_inplace(specfile, tmp_path) == 0
+
+
+def test_end_to_end_package(src_path, tmp_path):
+    """
+    Packages a source directory containing a template, a plugin and a regular file. The
+    template should be rendered, the regular file copied and the plugin left out.
+    """
+    src = tmp_path / "src"
+    dst = tmp_path / "dst"
+    src.mkdir()
+    copy_file(src_path, src, "actual.dm.cpp")
+    copy_file(src_path, src, "custom_functions.dmx.py")
+    copy_file(src_path, src, "expected.cpp", "other.cpp")
+
+    specfile = src_path / "component_spec.json"
+    assert main.main_package(specfile, src, dst) == 1
+
+    assert sorted(path.name for path in dst.iterdir()) == ["actual.cpp", "other.cpp"]
+    with (src_path / "expected.cpp").open() as expected, (dst / "actual.cpp").open() as actual:
+        assert expected.read() == actual.read()
+
+
+def test_template_is_skipped_if_dependencies_are_unchanged(tmp_path):
+    """
+    Editing a field that a template does not read should not cause it to be rendered again,
+    while editing a field it does read should.
+    """
+    spec = {"flag_defaults": {"F": True}, "components": [{"name": "A", "tooltip": "a", "attributes": []}]}
+    specfile = tmp_path / "spec.json"
+    specfile.write_text(json.dumps(spec))
+    (tmp_path / "names.dm.txt").write_text("DATAMATIC_BEGIN\n{{Comp::name}}\nDATAMATIC_END\n")
+    (tmp_path / "tips.dm.txt").write_text("DATAMATIC_BEGIN\n{{Comp::tooltip}}\nDATAMATIC_END\n")
+
+    assert main.main_inplace(specfile, tmp_path) == 2
+
+    spec["components"][0]["tooltip"] = "b"
+    specfile.write_text(json.dumps(spec))
+    mtime = (tmp_path / "names.txt").stat().st_mtime_ns
+
+    assert main.main_inplace(specfile, tmp_path) == 1
+    assert (tmp_path / "tips.txt").read_text() == "b\n"
+    assert (tmp_path / "names.txt").stat().st_mtime_ns == mtime
+
+
+def test_shared_cache_reuses_rendered_outputs(src_path, tmp_path):
+    """
+    A second invocation over the same files with its own cache dir but the same shared cache,
+    such as another build target, should reuse the output rendered by the first.
+    """
+    src = tmp_path / "src"
+    src.mkdir()
+    copy_file(src_path, src, "actual.dm.cpp")
+    copy_file(src_path, src, "custom_functions.dmx.py")
+    specfile = src_path / "component_spec.json"
+    shared = tmp_path / "shared"
+
+    first = main.Session()
+    options = Options(cache_dir=tmp_path / "first", shared_cache=shared)
+    assert main.main_inplace(specfile, src, options, first) == 1
+    assert first.render_cache(specfile, src).misses["result"] == 1
+
+    (src / "actual.cpp").unlink()
+    second = main.Session()
+    options = Options(cache_dir=tmp_path / "second", shared_cache=shared)
+    assert main.main_inplace(specfile, src, options, second) == 1
+    assert second.render_cache(specfile, src).hits["result"] == 1
+    assert (src / "actual.cpp").read_text() == (src_path / "expected.cpp").read_text()
+    assert not list(tmp_path.glob("**/*.lock"))
+
+
+def test_only_template_and_only_component(tmp_path):
+    """
+    --only-template should leave other templates alone, and --only-component should render
+    the named component again while reusing the output of the others from the last run.
+    """
+    spec = {
+        "flag_defaults": {"F": True},
+        "components": [
+            {"name": "A", "tooltip": "a", "attributes": []},
+            {"name": "B", "tooltip": "b", "attributes": []}
+        ]
+    }
+    specfile = tmp_path / "spec.json"
+    specfile.write_text(json.dumps(spec))
+    (tmp_path / "tips.dm.txt").write_text("DATAMATIC_BEGIN\n{{Comp::name}}={{Comp::tooltip}}\nDATAMATIC_END\n")
+    (tmp_path / "other.dm.txt").write_text("DATAMATIC_BEGIN\n{{Comp::name}}\nDATAMATIC_END\n")
+
+    session = main.Session()
+    options = Options(only_template="tips.*", only_components=["A"])
+    assert main.main_inplace(specfile, tmp_path, options, session) == 1
+    assert not (tmp_path / "other.txt").exists()
+    assert session.render_cache(specfile, tmp_path).misses["chunk"] == 1
+
+    spec["components"][0]["tooltip"] = "x"
+    specfile.write_text(json.dumps(spec))
+    session = main.Session()
+    assert main.main_inplace(specfile, tmp_path, options, session) == 1
+    assert session.render_cache(specfile, tmp_path).hits["chunk"] == 1
+    assert (tmp_path / "tips.txt").read_text() == "A=x\nB=b\n"
+
+    with pytest.raises(RuntimeError):
+        main.main_inplace(specfile, tmp_path, Options(only_components=["C"]))
+
+
+def test_full_run_after_only_component(tmp_path, monkeypatch):
+    """
+    An --only-component run reuses the output of the other components even if it reads
+    a component that changed, so a full run afterwards must render the template again.
+    """
+    monkeypatch.setattr(fileio, "RACY_NS", -1)  # Trust outputs written during the test
+    spec = {
+        "flag_defaults": {"F": True},
+        "components": [
+            {"name": "A", "of": "A", "type": "int", "attributes": []},
+            {"name": "B", "of": "A", "attributes": []}
+        ]
+    }
+    specfile = tmp_path / "spec.json"
+    specfile.write_text(json.dumps(spec))
+    (tmp_path / "types.dmx.py").write_text(
+        "def main(register):\n"
+        "    @register.compmethod\n"
+        "    @register.reads('Comp::*')\n"
+        "    def linked_type(ctx):\n"
+        "        return ctx.index.components_by('name')[ctx.comp['of']]['type']\n"
+    )
+    (tmp_path / "types.dm.txt").write_text("DATAMATIC_BEGIN\n{{Comp::name}}:{{Comp::linked_type}}\nDATAMATIC_END\n")
+
+    options = Options(only_components=["A"])
+    assert main.main_inplace(specfile, tmp_path, options, main.Session()) == 1
+    assert (tmp_path / "types.txt").read_text() == "A:int\nB:int\n"
+
+    spec["components"][0]["type"] = "float"
+    specfile.write_text(json.dumps(spec))
+    assert main.main_inplace(specfile, tmp_path, options, main.Session()) == 1
+    assert (tmp_path / "types.txt").read_text() == "A:float\nB:int\n"
+
+    assert main.main_inplace(specfile, tmp_path, Options(), main.Session()) == 1
+    assert (tmp_path / "types.txt").read_text() == "A:float\nB:float\n"
+
+
+UPPER = f"{shlex.quote(sys.executable)} -c \"import sys; sys.stdout.write(sys.stdin.read().upper())\""
+
+
+def test_post_process_only_runs_for_changed_output(tmp_path):
+    """
+    Outputs should be passed through the post-process command, including templates that
+    were skipped before the command was configured, and the command should not run again
+    for output that has not changed.
+    """
+    spec = {"flag_defaults": {"F": True}, "components": [{"name": "a", "attributes": []}]}
+    specfile = tmp_path / "spec.json"
+    specfile.write_text(json.dumps(spec))
+    (tmp_path / "names.dm.txt").write_text("DATAMATIC_BEGIN\n{{Comp::name}}\nDATAMATIC_END\n")
+
+    assert main.main_inplace(specfile, tmp_path) == 1
+    assert (tmp_path / "names.txt").read_text() == "a\n"
+
+    options = Options(post_process={".txt": UPPER})
+    session = main.Session()
+    assert main.main_inplace(specfile, tmp_path, options, session) == 1
+    assert (tmp_path / "names.txt").read_text() == "A\n"
+    assert session.report.counters["post_process_runs"] == 1
+
+    session = main.Session()
+    assert main.main_inplace(specfile, tmp_path, options, session) == 0
+    assert session.report.counters["post_process_runs"] == 0
+
+    # Changing the template renders it again, but its raw output has not changed
+    (tmp_path / "names.dm.txt").write_text("DATAMATIC_BEGIN\n{{Comp::name}}\nDATAMATIC_END")
+    session = main.Session()
+    assert main.main_inplace(specfile, tmp_path, options, session) == 0
+    assert session.report.counters["post_process_runs"] == 0
+    assert session.report.counters["post_process_skipped"] == 1
+
+
+def test_post_process_into_archive(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    spec = {"flag_defaults": {"F": True}, "components": [{"name": "a", "attributes": []}]}
+    specfile = tmp_path / "spec.json"
+    specfile.write_text(json.dumps(spec))
+    (src / "names.dm.txt").write_text("DATAMATIC_BEGIN\n{{Comp::name}}\nDATAMATIC_END\n")
+
+    dst = tmp_path / "out.tar"
+    main.main_package(specfile, src, dst, Options(post_process={".txt": UPPER}))
+    with tarfile.open(dst) as tar:
+        assert tar.extractfile("names.txt").read() == b"A\n"
+
+
+def test_end_to_end_batch(src_path, tmp_path):
+    """
+    Runs a batch of two package jobs over the same source directory, checking that both
+    produce the expected output.
+    """
+    src = tmp_path / "src"
+    src.mkdir()
+    copy_file(src_path, src, "actual.dm.cpp")
+    copy_file(src_path, src, "custom_functions.dmx.py")
+    copy_file(src_path, tmp_path, "component_spec.json")
+
+    jobs = {
+        "jobs": [
+            {"mode": "package", "spec": "component_spec.json", "src": "src", "dst": "client"},
+            {"mode": "package", "spec": "component_spec.json", "src": "src", "dst": "server"},
+        ]
+    }
+    jobfile = tmp_path / "jobs.json"
+    jobfile.write_text(json.dumps(jobs))
+
+    assert main.main_batch(jobfile) == 2
+
+    expected = (src_path / "expected.cpp").read_text()
+    assert (tmp_path / "client" / "actual.cpp").read_text() == expected
+    assert (tmp_path / "server" / "actual.cpp").read_text() == expected
+
+
+def test_batch_rejects_invalid_jobs(tmp_path):
+    jobfile = tmp_path / "jobs.json"
+    jobfile.write_text(json.dumps({"jobs": [{"mode": "other", "spec": "spec.json"}]}))
+    with pytest.raises(RuntimeError):
+        main.load_jobs(jobfile)
+
+    jobfile.write_text(json.dumps({"jobs": [{"mode": "package", "spec": "spec.json", "src": "src"}]}))
+    with pytest.raises(RuntimeError):
+        main.load_jobs(jobfile)
+
+
+def test_report(src_path, tmp_path, capsys):
+    """
+    Runs the inplace tool quietly with a report, checking the report describes the run.
+    """
+    copy_file(src_path, tmp_path, "actual.dm.cpp")
+    copy_file(src_path, tmp_path, "custom_functions.dmx.py")
+
+    report_file = tmp_path / "report.json"
+    options = Options(quiet=True, report=report_file)
+    assert main.main_inplace(src_path / "component_spec.json", tmp_path, options) == 1
+    assert "Generated file" not in capsys.readouterr().out
+
+    with report_file.open() as f:
+        report = json.load(f)
+
+    assert {"scan", "spec_load", "validation", "plugin_import", "render", "write"} <= set(report["phases"])
+    assert report["counters"]["files_written"] == 1
+    assert report["counters"]["bytes_written"] == (tmp_path / "actual.cpp").stat().st_size
+    assert [file["status"] for file in report["files"]] == ["written"]
+    assert "block" in report["caches"]
+
+
+@pytest.mark.parametrize("archive_name", ["out.tar", "out.tar.gz", "out.zip"])
+def test_end_to_end_package_archive(src_path, tmp_path, archive_name):
+    """
+    Packages straight into an archive, checking the contents and that packaging the same
+    input twice gives an identical archive.
+    """
+    src = tmp_path / "src"
+    src.mkdir()
+    copy_file(src_path, src, "actual.dm.cpp")
+    copy_file(src_path, src, "custom_functions.dmx.py")
+    copy_file(src_path, src, "expected.cpp", "other.cpp")
+
+    specfile = src_path / "component_spec.json"
+    first = tmp_path / f"first_{archive_name}"
+    second = tmp_path / f"second_{archive_name}"
+    assert main.main_package(specfile, src, first) == 1
+    (src / "other.cpp").touch()  # A new mtime must not change the archive
+    assert main.main_package(specfile, src, second) == 1
+    assert first.read_bytes() == second.read_bytes()
+
+    expected = (src_path / "expected.cpp").read_bytes()
+    if archive_name.endswith(".zip"):
+        with zipfile.ZipFile(first) as zf:
+            assert zf.namelist() == ["actual.cpp", "other.cpp"]
+            assert zf.read("actual.cpp") == expected
+    else:
+        with tarfile.open(first) as tar:
+            assert tar.getnames() == ["actual.cpp", "other.cpp"]
+            assert tar.extractfile("actual.cpp").read() == expected
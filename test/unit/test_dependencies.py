@@ -0,0 +1,83 @@
+"""
+Tests for working out which parts of the spec a template depends on.
+"""
+from datamatic import dependencies, method_register
+import pytest
+
+
+@pytest.fixture
+def reg():
+    mreg = method_register.MethodRegister()
+    mreg.load_builtins()
+    return mreg
+
+
+@pytest.fixture
+def spec():
+    return {
+        "components": [
+            {"name": "a", "tooltip": "A", "attributes": [{"name": "x", "default": "1"}]},
+            {"name": "b", "tooltip": "B", "attributes": []},
+        ]
+    }
+
+
+def test_field_lookups_and_declared_functions(reg):
+    lines = ["{{Comp::name}}{{Comp::if_not_last(',')}}", "{{Attr::default}}{{Global::version}}"]
+    deps = dependencies.template_dependencies("file", lines, reg)
+    assert {"structure", "Comp::name", "Attr::default", "Global::version"} <= deps
+    assert dependencies.code_dependency(reg.get("Comp", "if_not_last")) in deps
+
+
+def test_templates_depend_on_all_package_sources(reg):
+    deps = dependencies.template_dependencies("file", ["plain text"], reg)
+    for module in ("generator.py", "views.py", "index.py", "utilities.py"):
+        assert any(dep.startswith("code:") and dep.endswith(module) for dep in deps)
+
+
+def test_undeclared_function_is_untracked(reg):
+    @reg.compmethod
+    def custom(ctx):
+        return ""
+
+    lines = ["{{Comp::custom}}"]
+    assert dependencies.template_dependencies("file", lines, reg) is dependencies.UNTRACKED
+
+
+def test_braces_that_are_not_tokens(reg):
+    lines = ["int a[1][1] = {{0}};", "{{Comp::name}} b[1][1] = {{ {1} }};"]
+    deps = dependencies.template_dependencies("file", lines, reg)
+    assert deps is not dependencies.UNTRACKED
+    assert "Comp::name" in deps
+
+
+def test_malformed_token_is_untracked(reg):
+    lines = ["{{ {{Comp::name}} }}"]
+    assert dependencies.template_dependencies("file", lines, reg) is dependencies.UNTRACKED
+
+
+def test_declared_plugin_function(reg):
+    @reg.compmethod
+    @reg.reads("Comp::tooltip")
+    def custom(ctx):
+        return ctx.comp["tooltip"]
+
+    deps = dependencies.template_dependencies("file", ["{{Comp::custom}}"], reg)
+    assert "Comp::tooltip" in deps
+
+
+def test_fingerprints_only_change_for_edited_fields(spec):
+    before = dependencies.Fingerprints(spec).all({"structure", "Comp::name", "Comp::tooltip", "Attr::default"})
+
+    spec["components"][0]["tooltip"] = "changed"
+    after = dependencies.Fingerprints(spec)
+    assert after.unchanged({dep: before[dep] for dep in ["structure", "Comp::name", "Attr::default"]})
+    assert not after.unchanged({"Comp::tooltip": before["Comp::tooltip"]})
+
+
+def test_partials_are_dependencies(reg, tmp_path):
+    (tmp_path / "part.dmp.txt").write_text("{{Comp::tooltip}}\n")
+    lines = ["DATAMATIC_BEGIN", "DATAMATIC_INCLUDE part.dmp.txt", "DATAMATIC_END"]
+    deps = dependencies.template_dependencies(tmp_path / "a.dm.txt", lines, reg)
+    assert "Comp::tooltip" in deps
+    assert f"file:{tmp_path / 'part.dmp.txt'}" in deps
@@ -0,0 +1,43 @@
+"""
+Tests for the threaded file helpers.
+"""
+import time
+from datamatic import fileio
+
+
+def test_read_ahead_preserves_order():
+    def read(n):
+        time.sleep(0.001 * (10 - n))  # Later items finish first
+        return n * 2
+
+    with fileio.FilePool(workers=4, max_pending=4) as pool:
+        assert list(pool.read_ahead(range(10), read)) == [(n, n * 2) for n in range(10)]
+
+
+def test_submit_is_bounded():
+    with fileio.FilePool(workers=2, max_pending=2) as pool:
+        futures = [pool.submit(time.sleep, 0.001) for _ in range(10)]
+        assert all(future.result() is None for future in futures)
+
+
+def test_file_lock_is_exclusive(tmp_path):
+    events = []
+    lock_path = fileio.lock_path(tmp_path / "out.txt")
+
+    def hold(name):
+        with fileio.FileLock(lock_path):
+            assert lock_path.exists()
+            events.append(f"{name} start")
+            time.sleep(0.05)
+            events.append(f"{name} end")
+
+    with fileio.FilePool(workers=2) as pool:
+        futures = [pool.submit(hold, name) for name in "ab"]
+        for future in futures:
+            future.result()
+
+    assert events in (
+        ["a start", "a end", "b start", "b end"],
+        ["b start", "b end", "a start", "a end"]
+    )
+    assert list(tmp_path.iterdir()) == []
@@ -1,5 +1,7 @@
-from datamatic import generator, method_register, main
+from datamatic import generator, method_register, main, cache
+from datamatic.options import Options
 from datamatic.generator import Token
+import os
 import pytest
 from pathlib import Path
 
@@ -73,6 +75,80 @@ def test_process_block():
     assert generator.process_block("file", lines, {}, spec, reg) == "first -> 1st\nsecond -> 2nd\n"
 
 
+def test_process_block_reuses_identical_blocks():
+    lines = [r"{{Comp::counted}}"]
+    spec = {"components": [{"name": "first", "attributes": []}]}
+    reg = method_register.MethodRegister()
+    reg.load_builtins()
+
+    calls = []
+
+    @reg.compmethod
+    def counted(ctx):
+        calls.append(ctx.comp["name"])
+        return ctx.comp["name"]
+
+    render_cache = cache.RenderCache()
+    assert generator.process_block("a", lines, {}, spec, reg, render_cache) == "first\n"
+    assert generator.process_block("b", lines, {}, spec, reg, render_cache) == "first\n"
+    assert calls == ["first"]
+    assert render_cache.hits["block"] == 1
+    assert render_cache.misses["block"] == 1
+
+
+def test_process_block_records_and_reuses_chunks():
+    lines = [r"{{Comp::name}}"]
+    spec = {"components": [{"name": "first", "attributes": []}, {"name": "second", "attributes": []}]}
+    reg = method_register.MethodRegister()
+    reg.load_builtins()
+
+    chunks = []
+    assert generator.process_block("file", lines, {}, spec, reg, chunks=chunks) == "first\nsecond\n"
+    assert chunks == [[("first", "first\n"), ("second", "second\n")]]
+
+    out = generator.process_block("file", lines, {}, spec, reg, reuse={"second": "old\n"})
+    assert out == "first\nold\n"
+
+
+@pytest.mark.skipif(not generator.can_render_in_parallel(), reason="requires fork")
+def test_parallel_process_block_matches_serial():
+    lines = [
+        r"{{Comp::name}}{{Comp::shout}}{{Comp::if_not_last(',')}}",
+        r"    {{Attr::name}}{{Attr::if_not_last(';')}}"
+    ]
+    spec = {
+        "components": [
+            {"name": f"comp{i}", "attributes": [{"name": "x"}, {"name": "y"}]} for i in range(20)
+        ]
+    }
+    reg = method_register.MethodRegister()
+    reg.load_builtins()
+
+    @reg.compmethod
+    def shout(ctx):
+        return ctx.comp["name"].upper()
+
+    serial = generator.process_block("file", lines, {}, spec, reg)
+    options = Options(workers=3, parallel_threshold=1)
+    with generator.worker_pool(spec, reg, options) as workers:
+        assert workers is not None
+        parallel = generator.process_block("file", lines, {}, spec, reg, options=options, workers=workers)
+    assert parallel == serial
+    assert serial.endswith("comp19COMP19\n    x;\n    y\n")
+
+
+@pytest.mark.skipif(not generator.can_render_in_parallel(), reason="requires fork")
+def test_parallel_process_block_raises_generator_errors():
+    lines = [r"{{Comp::missing::field}}"]
+    spec = {"components": [{"name": "a", "attributes": []}, {"name": "b", "attributes": []}]}
+    reg = method_register.MethodRegister()
+
+    options = Options(workers=2, parallel_threshold=1)
+    with generator.worker_pool(spec, reg, options) as workers:
+        with pytest.raises(generator.GeneratorError):
+            generator.process_block("file", lines, {}, spec, reg, options=options, workers=workers)
+
+
 def test_flag_application():
     spec = {
         "flag_defaults": {
@@ -192,4 +268,166 @@ def test_flagless_spec():
     }
     main.fill_flag_defaults(spec)
 
-    assert generator.apply_flags_to_spec(spec, {}) == spec
\ No newline at end of file
+    assert generator.apply_flags_to_spec(spec, {}) == spec
+
+
+def test_write_output_creates_and_skips_unchanged(tmp_path):
+    dst = tmp_path / "out.cpp"
+    assert generator.write_output(dst, "hello\n")
+    assert dst.read_text() == "hello\n"
+
+    mtime = dst.stat().st_mtime_ns
+    assert not generator.write_output(dst, "hello\n")
+    assert dst.stat().st_mtime_ns == mtime
+
+    assert generator.write_output(dst, "world\n")
+    assert dst.read_text() == "world\n"
+    assert [path.name for path in tmp_path.iterdir()] == ["out.cpp"]  # No temp files left behind
+
+
+def test_write_output_trusts_manifest(tmp_path, monkeypatch):
+    dst = tmp_path / "out.cpp"
+    manifest = cache.Manifest(tmp_path / "manifest.json")
+    assert generator.write_output(dst, "hello\n", manifest)
+    old = dst.stat().st_mtime_ns - 10_000_000_000
+    os.utime(dst, ns=(old, old))
+    assert not generator.write_output(dst, "hello\n", manifest)
+    manifest.save()
+
+    def fail(path):
+        raise AssertionError("the output should not be read")
+
+    monkeypatch.setattr(generator.fileio, "file_digest", fail)
+    manifest = cache.Manifest(tmp_path / "manifest.json")
+    assert not generator.write_output(dst, "hello\n", manifest)
+    assert generator.write_output(dst, "world\n", manifest)
+
+
+def test_write_output_does_not_trust_recent_records(tmp_path):
+    """
+    An output recorded right after it was written could be changed again without its mtime
+    changing, so it is read again rather than trusted.
+    """
+    dst = tmp_path / "out.cpp"
+    manifest = cache.Manifest(tmp_path / "manifest.json")
+    assert generator.write_output(dst, "hello\n", manifest)
+    stat = dst.stat()
+    assert not manifest.output_is_current(dst)
+
+    dst.write_text("world\n")
+    os.utime(dst, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert generator.write_output(dst, "hello\n", manifest)
+    assert dst.read_text() == "hello\n"
+
+
+def test_attr_lines_with_batch_functions():
+    lines = [r"{{Comp::name}}:", r"    {{Attr::upper}} {{Attr::name}} = {{Attr::default}}{{Attr::if_not_last(',')}} {}"]
+    spec = {
+        "components": [
+            {"name": "a", "attributes": [{"name": "x", "default": "1"}, {"name": "y", "default": "2"}]},
+            {"name": "b", "attributes": []},
+        ]
+    }
+    reg = method_register.MethodRegister()
+    reg.load_builtins()
+
+    calls = []
+
+    @reg.attrbatch
+    def upper(ctx, attrs):
+        calls.append(ctx.comp["name"])
+        return [attr["name"].upper() for attr in attrs]
+
+    out = generator.process_block("file", lines, {}, spec, reg)
+    assert out == "a:\n    X x = 1, {}\n    Y y = 2 {}\nb:\n"
+    assert calls == ["a"]  # Not called for components without attributes
+
+
+def test_attr_batch_function_must_return_a_value_per_attribute():
+    spec = {"components": [{"name": "a", "attributes": [{"name": "x"}]}]}
+    reg = method_register.MethodRegister()
+
+    @reg.attrbatch
+    def broken(ctx, attrs):
+        return []
+
+    with pytest.raises(generator.GeneratorError):
+        generator.process_block("file", [r"{{Attr::broken}}"], {}, spec, reg)
+
+
+def test_attr_functions_returning_tokens_are_expanded():
+    spec = {"components": [{"name": "a", "attributes": [{"name": "x"}, {"name": "y"}]}]}
+    reg = method_register.MethodRegister()
+
+    @reg.attrmethod
+    def indirect(ctx):
+        return "<{{Attr::name}}>"
+
+    assert generator.process_block("file", [r"{{Attr::indirect}}"], {}, spec, reg) == "<x>\n<y>\n"
+
+
+@pytest.mark.parametrize("line", [r"{{Attr::", r"{{Attr::name}} {{Attr::", r"{{Attr::unterminated}}"])
+def test_unterminated_attr_tokens(line):
+    spec = {"components": [{"name": "a", "attributes": [{"name": "x"}]}]}
+    reg = method_register.MethodRegister()
+
+    @reg.attrmethod
+    def unterminated(ctx):
+        return "{{Attr::name"
+
+    with pytest.raises(generator.GeneratorError):
+        generator.process_block("file", [line], {}, spec, reg)
+
+
+def test_partials_are_rendered_once_per_component(tmp_path):
+    (tmp_path / "inspector.dmp.cpp").write_text("inspect({{Comp::counted}});\n    field({{Attr::name}});\n")
+    spec = {"components": [{"name": "a", "attributes": [{"name": "x"}]}, {"name": "b", "attributes": []}]}
+    reg = method_register.MethodRegister()
+
+    calls = []
+
+    @reg.compmethod
+    def counted(ctx):
+        calls.append(ctx.comp["name"])
+        return ctx.comp["name"]
+
+    render_cache = cache.RenderCache()
+    first = ["// first", "DATAMATIC_INCLUDE inspector.dmp.cpp"]
+    second = ["// second", "    DATAMATIC_INCLUDE inspector.dmp.cpp"]
+    assert generator.process_block(tmp_path / "a.dm.cpp", first, {}, spec, reg, render_cache) == (
+        "// first\ninspect(a);\n    field(x);\n// first\ninspect(b);\n"
+    )
+    assert generator.process_block(tmp_path / "b.dm.cpp", second, {}, spec, reg, render_cache) == (
+        "// second\ninspect(a);\n    field(x);\n// second\ninspect(b);\n"
+    )
+    assert calls == ["a", "b"]
+    assert render_cache.hits["partial"] == 2
+
+
+def test_identical_blocks_include_partials_relative_to_their_file(tmp_path):
+    spec = {"components": [{"name": "x", "attributes": []}]}
+    reg = method_register.MethodRegister()
+    reg.load_builtins()
+    for directory in ("a", "b"):
+        (tmp_path / directory).mkdir()
+        (tmp_path / directory / "p.dmp.txt").write_text(directory.upper() + ":{{Comp::name}}\n")
+
+    render_cache = cache.RenderCache()
+    block = ["DATAMATIC_INCLUDE p.dmp.txt"]
+    assert generator.process_block(tmp_path / "a" / "t.dm.txt", block, {}, spec, reg, render_cache) == "A:x\n"
+    assert generator.process_block(tmp_path / "b" / "t.dm.txt", block, {}, spec, reg, render_cache) == "B:x\n"
+
+
+def test_partials_cannot_include_themselves(tmp_path):
+    (tmp_path / "loop.dmp.cpp").write_text("DATAMATIC_INCLUDE loop.dmp.cpp\n")
+    spec = {"components": [{"name": "a", "attributes": []}]}
+    reg = method_register.MethodRegister()
+
+    with pytest.raises(generator.GeneratorError):
+        generator.process_block(tmp_path / "a.dm.cpp", ["DATAMATIC_INCLUDE loop.dmp.cpp"], {}, spec, reg)
+
+
+def test_include_outside_block(tmp_path):
+    spec = {"components": []}
+    with pytest.raises(generator.GeneratorError):
+        generator.render(tmp_path / "a.dm.cpp", ["DATAMATIC_INCLUDE x.dmp.cpp\n"], spec, method_register.MethodRegister())
@@ -0,0 +1,59 @@
+"""
+Tests for the spec lookups available to functions as ctx.index.
+"""
+from datamatic import generator, main
+from datamatic.index import SpecIndex
+import pytest
+
+
+@pytest.fixture
+def spec():
+    spec = {
+        "flag_defaults": {"SAVE": True},
+        "components": [
+            {"name": "Transform", "attributes": [{"name": "pos", "type": "vec3"}]},
+            {"name": "Debug", "flags": {"SAVE": False}, "attributes": []},
+            {"name": "Parent", "attributes": [
+                {"name": "id", "type": "Transform"},
+                {"name": "cache", "type": "Transform", "flags": {"SAVE": False}},
+            ]},
+        ]
+    }
+    main.fill_flag_defaults(spec)
+    return spec
+
+
+def test_components_by_field(spec):
+    index = SpecIndex(spec, {"SAVE": True})
+    by_name = index.components_by("name")
+    assert set(by_name) == {"Transform", "Parent"}
+    assert by_name["Transform"] is spec["components"][0]
+    assert index.components_by("name") is by_name  # Built once
+
+
+def test_attributes_by_field(spec):
+    index = SpecIndex(spec, {"SAVE": True})
+    comps = spec["components"]
+    assert index.attributes_by("type")["Transform"] == [(comps[2], comps[2]["attributes"][0])]
+
+    index = SpecIndex(spec, {})
+    assert len(index.attributes_by("type")["Transform"]) == 2
+
+
+def test_positions(spec):
+    index = SpecIndex(spec, {"SAVE": True})
+    transform, debug, parent = spec["components"]
+    assert index.position(transform) == 0
+    assert index.position(parent) == 1
+    assert index.position(debug) is None
+    assert index.attr_position(parent, parent["attributes"][0]) == 0
+    assert index.attr_position(parent, parent["attributes"][1]) is None
+
+
+def test_context_position(spec):
+    parent = spec["components"][2]
+    ctx = generator.Context(spec=spec, comp=parent, attr=None, flags={"SAVE": True})
+    assert ctx.position == 1
+
+    ctx = generator.Context(spec=spec, comp=parent, attr=parent["attributes"][0], flags={"SAVE": True})
+    assert ctx.position == 0
@@ -0,0 +1,85 @@
+"""
+Tests for reading specs from files, JSON Lines files and directories.
+"""
+import json
+import os
+from datamatic import loader
+import pytest
+
+
+def write_json(path, obj):
+    with path.open("w") as f:
+        json.dump(obj, f)
+
+
+def test_single_file(tmp_path):
+    spec = {"flag_defaults": {"A": True}, "components": [{"name": "a", "attributes": []}]}
+    write_json(tmp_path / "spec.json", spec)
+    assert loader.read_spec(tmp_path / "spec.json") == spec
+
+
+def test_jsonl_file(tmp_path):
+    lines = [
+        {"flag_defaults": {"A": True}, "components": []},
+        {"name": "a", "attributes": []},
+        {"name": "b", "attributes": []},
+    ]
+    with (tmp_path / "spec.jsonl").open("w") as f:
+        f.write("\n".join(json.dumps(line) for line in lines) + "\n")
+
+    assert loader.read_spec(tmp_path / "spec.jsonl") == {
+        "flag_defaults": {"A": True},
+        "components": [{"name": "a", "attributes": []}, {"name": "b", "attributes": []}]
+    }
+
+
+def test_directory_is_merged_in_sorted_order(tmp_path):
+    (tmp_path / "sub").mkdir()
+    write_json(tmp_path / "_spec.json", {"flag_defaults": {"A": True}, "components": []})
+    write_json(tmp_path / "b.json", {"name": "b", "attributes": []})
+    write_json(tmp_path / "a.json", {"name": "a", "attributes": []})
+    write_json(tmp_path / "sub" / "c.json", [{"name": "c", "attributes": []}])
+
+    spec = loader.read_spec(tmp_path)
+    assert spec["flag_defaults"] == {"A": True}
+    assert [comp["name"] for comp in spec["components"]] == ["a", "b", "c"]
+
+
+def test_conflicting_top_level_keys(tmp_path):
+    write_json(tmp_path / "a.json", {"flag_defaults": {"A": True}, "components": []})
+    write_json(tmp_path / "b.json", {"flag_defaults": {"A": False}, "components": []})
+
+    with pytest.raises(RuntimeError):
+        loader.read_spec(tmp_path)
+
+
+def test_cached_files_are_not_mutated(tmp_path):
+    write_json(tmp_path / "a.json", {"name": "a", "attributes": [{"name": "x"}]})
+
+    spec = loader.read_spec(tmp_path)
+    spec["components"][0]["flags"] = {"A": True}
+    spec["components"][0]["attributes"][0]["flags"] = {"A": True}
+
+    assert loader.read_spec(tmp_path) == {"components": [{"name": "a", "attributes": [{"name": "x"}]}]}
+
+
+def test_parsed_files_are_kept_in_the_cache_dir(tmp_path):
+    spec_dir = tmp_path / "spec"
+    spec_dir.mkdir()
+    write_json(spec_dir / "a.json", {"name": "a", "attributes": []})
+    write_json(spec_dir / "b.json", {"name": "b", "attributes": []})
+    for path in spec_dir.iterdir():
+        os.utime(path, ns=(1_000_000_000, 1_000_000_000))  # Old enough to be trusted
+
+    cache_dir = tmp_path / "cache"
+    before = loader.stats.copy()
+    loader.read_spec(spec_dir, cache_dir)
+    assert loader.stats["misses"] - before["misses"] == 2
+
+    write_json(spec_dir / "b.json", {"name": "c", "attributes": []})
+    os.utime(spec_dir / "b.json", ns=(2_000_000_000, 2_000_000_000))
+    before = loader.stats.copy()
+    spec = loader.read_spec(spec_dir, cache_dir)
+    assert loader.stats["hits"] - before["hits"] == 1
+    assert loader.stats["misses"] - before["misses"] == 1
+    assert [comp["name"] for comp in spec["components"]] == ["a", "c"]
@@ -107,4 +107,28 @@ def test_builtin_conditionals_attr(reg, attribute):
     assert reg.get("Attr", "if_first")(ctx, "a") == "a"
     assert reg.get("Attr", "if_not_first")(ctx, "a") == ""
     assert reg.get("Attr", "if_last")(ctx, "a") == "a"
-    assert reg.get("Attr", "if_not_last")(ctx, "a") == ""
\ No newline at end of file
+    assert reg.get("Attr", "if_not_last")(ctx, "a") == ""
+
+
+def test_batch_methods_share_the_attr_namespace(reg):
+    def batched(ctx, attrs):
+        return []
+
+    reg.attrbatch(batched)
+    assert reg.get_batch("batched") == batched
+    assert reg.find("Attr", "batched") == batched
+
+    with pytest.raises(RuntimeError):
+        reg.attrmethod(batched)
+
+
+def test_batch_and_attr_methods_cannot_share_a_name():
+    reg = method_register.MethodRegister()
+    reg.attrbatch(dummy)
+    with pytest.raises(RuntimeError):
+        reg.attrmethod(dummy)
+
+    reg = method_register.MethodRegister()
+    reg.attrmethod(dummy)
+    with pytest.raises(RuntimeError):
+        reg.attrbatch(dummy)
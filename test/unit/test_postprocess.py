@@ -0,0 +1,43 @@
+"""
+Tests for running generated files through post-process commands.
+"""
+import shlex
+import sys
+from datamatic import postprocess
+import pytest
+
+
+UPPER = f"{shlex.quote(sys.executable)} -c \"import sys; sys.stdout.write(sys.stdin.read().upper())\""
+
+
+def test_post_process_runs_command_and_caches(tmp_path):
+    processor = postprocess.PostProcessor({".txt": UPPER}, tmp_path / "cache")
+    dst = tmp_path / "out.txt"
+    assert processor.command_for(dst) == UPPER
+    assert processor.command_for(tmp_path / "out.cpp") is None
+
+    key = processor.key(tmp_path, UPPER, b"hello\n")
+    assert processor.run(dst, tmp_path, UPPER, b"hello\n", key) == b"HELLO\n"
+
+    # A cached result is returned without running the command
+    assert processor.run(dst, tmp_path, "no-such-command", b"hello\n", key) == b"HELLO\n"
+
+
+def test_post_process_failure(tmp_path):
+    processor = postprocess.PostProcessor({}, tmp_path / "cache")
+    dst = tmp_path / "out.txt"
+    command = f"{shlex.quote(sys.executable)} -c \"import sys; sys.exit('bad input')\""
+    with pytest.raises(RuntimeError, match="bad input"):
+        processor.run(dst, tmp_path, command, b"hello\n", processor.key(tmp_path, command, b"hello\n"))
+
+
+def test_post_process_key_includes_the_config_file(tmp_path):
+    processor = postprocess.PostProcessor({}, tmp_path / "cache")
+    sub = tmp_path / "sub"
+    sub.mkdir()
+    before = processor.key(sub, "clang-format -i", b"int a;")
+
+    (tmp_path / ".clang-format").write_text("BasedOnStyle: LLVM\n")
+    fresh = postprocess.PostProcessor({}, tmp_path / "cache")
+    assert fresh.config(sub, "clang-format -i") == b"BasedOnStyle: LLVM\n"
+    assert fresh.key(sub, "clang-format -i", b"int a;") != before
@@ -1,7 +1,9 @@
 """
 Validator unit tests.
 """
-from datamatic import validator
+import json
+import os
+from datamatic import validator, main
 from datamatic.validator import InvalidSpecError
 import pytest
 
@@ -107,4 +109,73 @@ def test_validator_components_must_be_a_list():
 def test_objects_cant_have_flags_if_no_defaults():
     obj = {"flags": {}}
     with pytest.raises(InvalidSpecError):
-        validator.validate_flags_on_object(obj, None)
\ No newline at end of file
+        validator.validate_flags_on_object(obj, None)
+
+
+def test_validator_reports_all_errors():
+    spec = {
+        "flag_defaults": {"foo": True},
+        "components": [
+            {"name": "a", "flags": {"foo": 1}, "attributes": []},
+            {"name": "b", "flags": {"foo": True}, "attributes": [{"flags": {"bar": True}}, {}]},
+        ]
+    }
+    with pytest.raises(InvalidSpecError) as e:
+        validator.run(spec)
+
+    message = str(e.value)
+    assert "3 error(s)" in message
+    assert "components[0] (a)" in message
+    assert "components[1] (b): attributes[0]" in message
+    assert "components[1] (b): attributes[1]" in message
+
+
+def write_fragment(path, components, mtime_ns):
+    path.write_text(json.dumps({"flag_defaults": {"foo": True}, "components": components}))
+    os.utime(path, ns=(mtime_ns, mtime_ns))  # Old enough to be trusted
+
+
+def test_unchanged_spec_files_are_not_validated_again(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    spec_dir = tmp_path / "spec"
+    spec_dir.mkdir()
+    write_fragment(spec_dir / "a.json", [{"name": "a", "attributes": []}], 1_000_000_000)
+    write_fragment(spec_dir / "b.json", [{"name": "b", "attributes": []}, {"name": "c", "attributes": []}], 1_000_000_000)
+    single = tmp_path / "single.json"
+    write_fragment(single, [{"name": "d", "attributes": []}], 1_000_000_000)
+
+    checked = []
+    original = validator.component_errors
+
+    def component_errors(comp, flag_names):
+        checked.append(comp["name"])
+        return original(comp, flag_names)
+
+    monkeypatch.setattr(validator, "component_errors", component_errors)
+
+    for specfile in [spec_dir, single, spec_dir, single]:  # Specs sharing a cache dir keep their own records
+        main.load_spec(specfile, cache_dir)
+    assert checked == ["a", "b", "c", "d"]
+
+    write_fragment(spec_dir / "b.json", [{"name": "b", "attributes": []}, {"name": "x", "attributes": []}], 2_000_000_000)
+    main.load_spec(spec_dir, cache_dir)
+    assert checked == ["a", "b", "c", "d", "b", "x"]
+
+
+def test_invalid_spec_files_are_validated_again(tmp_path):
+    cache_dir = tmp_path / "cache"
+    spec_dir = tmp_path / "spec"
+    spec_dir.mkdir()
+    write_fragment(spec_dir / "a.json", [{"name": "a", "attributes": []}], 1_000_000_000)
+    invalid = [
+        {"name": "b", "attributes": [{"flags": {"foo": 1}}]},
+        {"name": "c", "flags": {"bar": True}, "attributes": []},
+    ]
+    write_fragment(spec_dir / "b.json", invalid, 1_000_000_000)
+
+    for _ in range(2):
+        with pytest.raises(InvalidSpecError) as e:
+            main.load_spec(spec_dir, cache_dir)
+        assert "2 error(s)" in str(e.value)
+        assert "components[1] (b)" in str(e.value)
+        assert "components[2] (c)" in str(e.value)
@@ -0,0 +1,56 @@
+"""
+Tests for the read-only, flag filtered views of the spec given to functions.
+"""
+from datamatic import generator, method_register, main
+from datamatic.views import SpecView
+import pytest
+
+
+@pytest.fixture
+def spec():
+    spec = {
+        "flag_defaults": {"SAVE": True},
+        "version": 3,
+        "components": [
+            {"name": "a", "attributes": [{"name": "x"}, {"name": "y", "flags": {"SAVE": False}}]},
+            {"name": "b", "flags": {"SAVE": False}, "attributes": []},
+        ]
+    }
+    main.fill_flag_defaults(spec)
+    return spec
+
+
+def test_spec_view_filters_and_hides_flags(spec):
+    view = SpecView(spec, {"SAVE": True})
+    assert dict(view) == {"version": 3, "components": view["components"]}
+    assert len(view["components"]) == 1
+
+    comp = view["components"][0]
+    assert dict(comp) == {"name": "a", "attributes": comp["attributes"]}
+    assert [dict(attr) for attr in comp["attributes"]] == [{"name": "x"}]
+    assert "flags" not in comp
+    assert "flags" not in comp["attributes"][0]
+
+
+def test_views_are_shared_and_read_only(spec):
+    view = SpecView(spec, {})
+    assert view["components"] is view["components"]
+    assert view["components"][0]["attributes"] is view["components"][0]["attributes"]
+    assert len(view["components"]) == 2
+
+    with pytest.raises(TypeError):
+        view["components"][0]["name"] = "c"
+
+
+def test_functions_receive_views(spec):
+    reg = method_register.MethodRegister()
+    seen = []
+
+    @reg.compmethod
+    def names(ctx):
+        seen.append(ctx.comp)
+        return ",".join(comp["name"] for comp in ctx.spec["components"])
+
+    out = generator.process_block("file", ["{{Comp::names}}"], {"SAVE": True}, spec, reg)
+    assert out == "a\n"
+    assert "flags" not in seen[0]